@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""Memory and lookup time of the Catalog versus the former metadata dict of
+dicts + rmetadata nested dicts, on synthetic track records."""
+
+from __future__ import print_function
+
+import time
+import argparse
+import tracemalloc
+from random import Random
+
+from catalog import Catalog
+from playlisttools import humanize_number
+
+
+def synthetic_records(n, seed=0):
+    """Yield (path, record) with ~10 tracks per album and ~5 albums per
+    artist."""
+    rng = Random(seed)
+    for i in range(n):
+        artist = 'Artist %d' % (i // 50)
+        album = 'Album %d' % (i // 10)
+        title = 'Title %d' % i
+        number = str(i % 10 + 1)
+        path = '/media/music/%s/%s/%s-%s.mp3' % (artist, album, number, title)
+        yield path, {'a': artist, 'b': album, 't': title, 'n': number,
+                     'y': str(1950 + i % 70),
+                     'bitrate': rng.choice((128000, 192000, 320000)),
+                     'length': rng.uniform(120, 400)}
+
+
+def build_dicts(records):
+    metadata, rmetadata = {}, {}
+    for path, record in records:
+        metadata[path] = dict(record)
+        artist = rmetadata.setdefault(record.get('a', 'unknown artist'), {})
+        album = artist.setdefault(record.get('b', 'unknown album'), {})
+        album.setdefault(record.get('t', 'unknown track'), set()).add(path)
+    return metadata, rmetadata
+
+
+def build_catalog(records):
+    catalog = Catalog()
+    for path, record in records:
+        catalog.add(path, record)
+    return catalog
+
+
+def measure(build, n):
+    """Memory used by the structure, excluding the path strings (shared by
+    both)."""
+    records = list(synthetic_records(n))
+    # Copy the tag strings, as each file scan creates new ones.
+    records = [(path, dict((k, (v + ' ')[:-1] if isinstance(v, str) else v)
+                           for k, v in record.items()))
+               for path, record in records]
+    tracemalloc.start()
+    start = time.time()
+    structure = build(records)
+    elapsed = time.time() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, records, elapsed, current
+
+
+def main(sizes=[100000, 1000000], nlookups=100000):
+    for n in sizes:
+        print("%d records" % n)
+        (metadata, rmetadata), records, t_dicts, m_dicts = measure(build_dicts, n)
+        keys = [(r['a'], r['b'], r['t'], path) for path, r in
+                Random(1).sample(records, min(nlookups, n))]
+        start = time.time()
+        for a, b, t, path in keys:
+            metadata[path]['bitrate']
+            rmetadata.get(a, {}).get(b, {}).get(t)
+        l_dicts = time.time() - start
+        del metadata, rmetadata
+
+        catalog, records, t_cat, m_cat = measure(build_catalog, n)
+        start = time.time()
+        for a, b, t, path in keys:
+            catalog[path].bitrate
+            catalog.lookup(a, b, t)
+        l_cat = time.time() - start
+        del catalog, records
+
+        for name, t_build, mem, t_lookup in [('dicts', t_dicts, m_dicts, l_dicts),
+                                             ('catalog', t_cat, m_cat, l_cat)]:
+            print("  %-8s build %7.3f s  memory %12s  %d lookups %7.3f s" % (
+                  name, t_build, humanize_number(mem), len(keys), t_lookup))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--sizes', type=int, nargs='*',
+                        default=[100000, 1000000],
+                        help='numbers of records [%(default)s]')
+    parser.add_argument('-l', '--nlookups', type=int, default=100000,
+                        help='[%(default)s]')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""Compare the copy backends and preallocation modes of coolsync on a target
+directory (ideally a tmpfs or a loopback-mounted FAT image). The bytes
+written by the process (/proc/self/io, Linux) show the files written twice
+when the preallocation zero-fills them (posix_fallocate on FAT/exFAT)."""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import time
+import shutil
+import argparse
+import tempfile
+
+from copyengine import CopyScheduler, FileCopier, available_backends, \
+                       available_preallocations
+from playlisttools import humannumber2int, humanize_number
+
+
+def make_sources(srcdir, nfiles, filesize):
+    chunk = os.urandom(min(filesize, 1024**2))
+    paths = []
+    for i in range(nfiles):
+        path = op.join(srcdir, 'track%04d.mp3' % i)
+        with open(path, 'wb') as F:
+            remaining = filesize
+            while remaining > 0:
+                F.write(chunk[:remaining])
+                remaining -= len(chunk)
+        paths.append(path)
+    return paths
+
+
+def written_bytes():
+    """Bytes written by write calls and bytes sent to the storage by this
+    process so far, or None (not on Linux)."""
+    try:
+        with open('/proc/self/io') as F:
+            counters = dict(line.split(':') for line in F)
+    except (IOError, OSError):
+        return None
+    return int(counters['wchar']), int(counters['write_bytes'])
+
+
+def bench_backend(paths, targetdir, backend, bufsize, preallocate,
+                  fsync_batch, workers):
+    destdir = tempfile.mkdtemp(prefix='bench-%s-' % backend, dir=targetdir)
+    filecopier = FileCopier(backend, bufsize, preallocate, fsync_batch)
+    copier = CopyScheduler(workers, copy=filecopier)
+    before = written_bytes()
+    start = time.time()
+    for path in paths:
+        copier.submit(path, op.join(destdir, op.basename(path)))
+    copied, failed = copier.wait()
+    # Written back, so that the device writes are counted.
+    os.sync()
+    elapsed = time.time() - start
+    after = written_bytes()
+    shutil.rmtree(destdir)
+    assert not failed, failed
+    written = None if before is None else (after[0] - before[0],
+                                           after[1] - before[1])
+    return elapsed, filecopier.fallbacks, written
+
+
+def main(targetdir, srcdir=None, nfiles=200, filesize='4MiB', bufsize='8MiB',
+         preallocations=None, fsync_batch=0, workers=1, repeat=3):
+    filesize = humannumber2int(filesize)
+    bufsize = humannumber2int(bufsize)
+    tmpsrc = srcdir is None
+    if tmpsrc:
+        srcdir = tempfile.mkdtemp(prefix='bench-src-')
+    try:
+        paths = make_sources(srcdir, nfiles, filesize)
+        total = nfiles * filesize
+        print("%d files, %s, %d workers" % (nfiles, humanize_number(total),
+                                            workers))
+        for backend in available_backends():
+            modes = preallocations or available_preallocations() + ['none']
+            for mode in modes:
+                runs = [bench_backend(paths, targetdir, backend, bufsize,
+                                      mode != 'none' and mode, fsync_batch,
+                                      workers)
+                        for _ in range(repeat)]
+                best = min(elapsed for elapsed, _, _ in runs)
+                fallbacks, written = runs[0][1:]
+                print("%-16s %-10s %8.3f s  %12s/s%s%s" % (backend, mode, best,
+                      humanize_number(int(total / best)),
+                      "  written: %s by write calls, %s to the device" % (
+                          humanize_number(written[0]),
+                          humanize_number(written[1])) if written else '',
+                      "  (%d fallbacks)" % fallbacks if fallbacks else ''))
+    finally:
+        if tmpsrc:
+            shutil.rmtree(srcdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('targetdir', nargs='?', default='/dev/shm',
+                        help='where to copy the files [%(default)s]')
+    parser.add_argument('-s', '--srcdir',
+                        help='where to create the source files [temporary dir]')
+    parser.add_argument('-n', '--nfiles', type=int, default=200,
+                        help='[%(default)s]')
+    parser.add_argument('-f', '--filesize', default='4MiB', help='[%(default)s]')
+    parser.add_argument('-b', '--bufsize', default='8MiB', help='[%(default)s]')
+    parser.add_argument('-P', '--preallocations', nargs='+',
+                        choices=available_preallocations() + ['none'],
+                        help='preallocation modes to compare [all]')
+    parser.add_argument('-F', '--fsync-batch', type=int, default=0,
+                        help='[%(default)s]')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='concurrent copies [%(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='keep the best of REPEAT runs [%(default)s]')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""Memory and time of PathSet versus sets of path strings, on synthetic
+playlists sharing long directory prefixes: building the set of a playlist,
+subtracting an exclude playlist (10% of the entries), and sampling tracks
+that are not in another set."""
+
+from __future__ import print_function
+
+import time
+import argparse
+import tracemalloc
+from random import Random
+
+from pathset import PathSet
+from playlisttools import humanize_number
+
+
+def synthetic_paths(n, seed=0):
+    """Paths of ~10 tracks per album and ~5 albums per artist, below a
+    long library root."""
+    rng = Random(seed)
+    root = '/media/user/External Drive/Music/Library/'
+    years = {}
+    for i in range(n):
+        year = years.setdefault(i // 10, 1950 + rng.randrange(70))
+        yield '%sArtist %d/Album %d (%d)/%02d - Title %d.mp3' % (
+              root, i // 50, i // 10, year, i % 10 + 1, i)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def build_memory(build, paths):
+    """Memory taken by the set built from copies of the paths (new strings,
+    as read from a playlist)."""
+    tracemalloc.start()
+    pathset = build((path + ' ')[:-1] for path in paths)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del pathset
+    return current
+
+
+def set_sample(paths, k, exclude, rng):
+    return set(rng.sample(sorted(paths - exclude), k))
+
+
+def main(sizes=[100000, 1000000], nsample=1000):
+    for n in sizes:
+        print("%d paths" % n)
+        paths = list(synthetic_paths(n))
+        exclude = paths[::10]
+        for name, build in [('set', set), ('PathSet', PathSet)]:
+            m_build = build_memory(build, paths)
+            pathset, t_build = timed(build, paths)
+            excluded = build(exclude)
+            rest, t_diff = timed(lambda: pathset - excluded)
+            start = time.time()
+            if name == 'set':
+                set_sample(pathset, nsample, excluded, Random(0))
+            else:
+                pathset.sample(nsample, Random(0), excluded)
+            t_sample = time.time() - start
+            print("  %-8s build %7.3f s  memory %12s  difference %7.3f s  "
+                  "sample %7.3f s" % (name, t_build, humanize_number(m_build),
+                                      t_diff, t_sample))
+            del pathset, excluded, rest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--sizes', type=int, nargs='*',
+                        default=[100000, 1000000],
+                        help='numbers of paths [%(default)s]')
+    parser.add_argument('-k', '--nsample', type=int, default=1000,
+                        help='size of the samples [%(default)s]')
+    args = parser.parse_args()
+    main(**vars(args))
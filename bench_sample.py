@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""Compare capacity_sample with the random-walk fixedsize_sample, on
+playlists of sparse files with realistic track sizes, and time the
+selection alone (fill_capacity, and fill_budgets with duration and per-artist
+budgets) on large synthetic track tables."""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from random import Random
+from array import array
+
+from playlisttools import fixedsize_sample, capacity_sample, fill_capacity, \
+                          humannumber2int
+from tracktable import TrackTable, fill_budgets
+
+
+def track_sizes(n, rng):
+    """Sizes of typical mp3 tracks (log-normal around 7 MiB)."""
+    return array('q', (int(rng.lognormvariate(15.8, 0.5)) for _ in range(n)))
+
+
+def track_table(sizes, rng):
+    """Table of the sizes, with lengths at 256 kbit/s and artists of 10
+    tracks or more (Pareto distributed: a few artists have most tracks)."""
+    n = len(sizes)
+    lengths = array('d', (size / 32000. for size in sizes))
+    artists = array('i')
+    while len(artists) < n:
+        ntracks = min(int(10 * rng.paretovariate(1.)), n - len(artists))
+        artists.extend(array('i', [len(artists)]) * ntracks)
+    return TrackTable(['track%07d.mp3' % i for i in range(n)], sizes, lengths,
+                      artists, artists)
+
+
+def make_sparse_files(dirname, sizes):
+    paths = []
+    for i, size in enumerate(sizes):
+        path = op.join(dirname, 'track%07d.mp3' % i)
+        with open(path, 'wb') as F:
+            F.truncate(size)
+        paths.append(path)
+    return paths
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main(nfiles=10000, nsizes=[100000, 1000000], maxsize='8GiB',
+         epsilon='300KiB', seed=0):
+    rng = Random(seed)
+    low = humannumber2int(maxsize) - humannumber2int(epsilon)
+    tmpdir = tempfile.mkdtemp(prefix='bench-sample-')
+    devnull = open(os.devnull, 'w')
+    try:
+        urlset = set(make_sparse_files(tmpdir, track_sizes(nfiles, rng)))
+        print("%d files, target %s - %s" % (nfiles, maxsize, epsilon))
+        for name, func, args in [
+                ('fixedsize_sample', fixedsize_sample, ()),
+                ('capacity_sample', capacity_sample, (seed,))]:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                elapsed, (size, sample) = timed(func, urlset, maxsize,
+                                                epsilon, *args)
+            finally:
+                sys.stderr = stderr
+            print("%-18s %8.3f s  %s (%d files)" % (name, elapsed,
+                  'ok' if size >= low else 'not converged', len(sample)))
+    finally:
+        shutil.rmtree(tmpdir)
+        devnull.close()
+
+    high = humannumber2int(maxsize)
+    for n in nsizes:
+        sizes = track_sizes(n, rng)
+        elapsed, (total, chosen) = timed(fill_capacity, sizes, low, high,
+                                         Random(seed))
+        print("fill_capacity %8d sizes %8.3f s  %s" % (n, elapsed,
+              'ok' if total >= low else 'not converged'))
+        table = track_table(sizes, rng)
+        for stratify in (None, 'artist'):
+            elapsed, (total, length, chosen) = timed(
+                    fill_budgets, table, low, high, 3600 * 100, 5, None,
+                    stratify, Random(seed))
+            print("fill_budgets  %8d tracks %8.3f s  %s (100 h, 5 per "
+                  "artist, stratify=%s: %d tracks, %.1f h)" % (n, elapsed,
+                  'ok' if total >= low else 'not converged', stratify,
+                  len(chosen), length / 3600))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nfiles', type=int, default=10000,
+                        help='number of files in the playlist [%(default)s]')
+    parser.add_argument('-N', '--nsizes', type=int, nargs='*',
+                        default=[100000, 1000000],
+                        help='sizes of the synthetic arrays [%(default)s]')
+    parser.add_argument('-s', '--maxsize', default='8GiB', help='[%(default)s]')
+    parser.add_argument('-e', '--epsilon', default='300KiB',
+                        help='[%(default)s]')
+    parser.add_argument('-S', '--seed', type=int, default=0, help='[%(default)s]')
+    args = parser.parse_args()
+    main(**vars(args))
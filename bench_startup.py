@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""Cold-start time of the `size` and `sample` subcommands of tracklistsync.py
+on a playlist of sparse files, each run in a new interpreter, and the
+heaviest imports (python -X importtime). Exit with status 1 if the best run
+of a subcommand takes longer than the limit."""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from random import Random
+
+from bench_sample import track_sizes, make_sparse_files
+from playlisttools import write_paths
+
+
+SCRIPT = op.join(op.dirname(op.abspath(__file__)), 'tracklistsync.py')
+
+
+def run(args, importtime=False):
+    """Wall time of the subcommand, and its stderr."""
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) \
+          + [SCRIPT] + args
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    _, err = proc.communicate()
+    elapsed = time.time() - start
+    if proc.returncode:
+        raise RuntimeError("%s failed:\n%s" % (' '.join(cmd), err))
+    return elapsed, err
+
+
+def heaviest_imports(importtime_log, top=5):
+    """[(cumulative microseconds, top-level module)] of an importtime log."""
+    imports = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only the modules imported directly (not nested).
+        if not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(nfiles=10000, repeat=5, limit=1.):
+    tmpdir = tempfile.mkdtemp(prefix='bench-startup-')
+    status = None
+    try:
+        paths = make_sparse_files(tmpdir, track_sizes(nfiles, Random(0)))
+        playlist = op.join(tmpdir, 'playlist.m3u')
+        with open(playlist, 'w') as F:
+            write_paths(paths, F)
+        print("%d files" % nfiles)
+        for name, args in [('size', ['size', playlist]),
+                           ('sample', ['sample', playlist, os.devnull,
+                                       '-s', '1GiB', '-S', '0'])]:
+            times = sorted(run(args)[0] for _ in range(repeat))
+            _, log = run(args, importtime=True)
+            print("%-8s best %6.3f s  median %6.3f s  %s" % (name, times[0],
+                  times[len(times) // 2],
+                  'ok' if times[0] < limit else 'SLOWER THAN %g s' % limit))
+            for cumulative, module in heaviest_imports(log):
+                print("    import %-20s %7.1f ms" % (module,
+                                                      cumulative / 1000.))
+            if times[0] >= limit:
+                status = 1
+    finally:
+        shutil.rmtree(tmpdir)
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nfiles', type=int, default=10000,
+                        help='number of files in the playlist [%(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='runs of each subcommand [%(default)s]')
+    parser.add_argument('-l', '--limit', type=float, default=1.,
+                        help='maximum time of the best run, in seconds '
+                             '[%(default)s]')
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
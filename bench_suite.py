@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""Benchmark suite of coolsync and the playlist tools, on a synthetic library
+of small tagged mp3/flac (and m4a/wma if ffmpeg is available) files.
+
+Times the destination scan, the playlist reading and sizing, the sampling and
+an end-to-end sync to a tmpfs. Results (seconds, throughput, peak memory)
+are saved as JSON, and can be compared to a saved baseline."""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import sys
+import json
+import time
+import shutil
+import struct
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import tracemalloc
+from random import Random
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from mutagen.id3 import ID3, TPE1, TALB, TIT2, TRCK, TDRC
+from mutagen.flac import FLAC
+
+import coolsync
+from playlisttools import iter_playlist, get_playlist_filesize, \
+                          fixedsize_sample, capacity_sample, humanize_number
+
+try:
+    quote = __import__('urllib.parse', fromlist=['quote']).quote
+except ImportError:
+    from urllib import quote
+
+
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413  # 128 kbps, 44.1 kHz
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 5
+
+
+def flac_stream(seconds, padding):
+    """Minimal FLAC stream: the STREAMINFO block and `padding` bytes of
+    (fake) frames."""
+    rate, channels, bits = 44100, 2, 16
+    info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    # sample rate (20 bits), channels - 1 (3), bits - 1 (5), samples (36)
+    info += struct.pack('>Q', rate << 44 | (channels - 1) << 41 |
+                              (bits - 1) << 36 | rate * seconds)
+    info += b'\x00' * 16  # MD5
+    return b'fLaC' + struct.pack('>I', 1 << 31 | len(info))[:1] + \
+           struct.pack('>I', len(info))[1:] + info + b'\x00' * padding
+
+
+def ffmpeg_template(ext, tmpdir):
+    """A short silent file encoded by ffmpeg, or None."""
+    codec = {'m4a': ['-c:a', 'aac', '-b:a', '64k'],
+             'wma': ['-c:a', 'wmav2', '-b:a', '64k']}[ext]
+    path = op.join(tmpdir, 'template.' + ext)
+    try:
+        subprocess.check_call(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi',
+                               '-i', 'anullsrc=r=44100:cl=stereo', '-t', '2']
+                              + codec + [path])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    with open(path, 'rb') as F:
+        return F.read()
+
+
+def tag_file(path, ext, artist, album, title, number):
+    if ext == 'mp3':
+        tags = ID3()
+        tags.add(TPE1(encoding=3, text=artist))
+        tags.add(TALB(encoding=3, text=album))
+        tags.add(TIT2(encoding=3, text=title))
+        tags.add(TRCK(encoding=3, text=str(number)))
+        tags.add(TDRC(encoding=3, text='2001'))
+        tags.save(path)
+    elif ext == 'flac':
+        audio = FLAC(path)
+        audio.update({'artist': artist, 'album': album, 'title': title,
+                      'tracknumber': str(number), 'date': '2001'})
+        audio.save()
+    elif ext == 'm4a':
+        from mutagen.mp4 import MP4
+        audio = MP4(path)
+        audio.update({'\xa9ART': artist, '\xa9alb': album, '\xa9nam': title,
+                      'trkn': [(number, TRACKS_PER_ALBUM)], '\xa9day': '2001'})
+        audio.save()
+    elif ext == 'wma':
+        from mutagen.asf import ASF
+        audio = ASF(path)
+        audio.update({'Author': artist, 'WM/AlbumTitle': album,
+                      'Title': title, 'WM/TrackNumber': str(number),
+                      'WM/Year': '2001'})
+        audio.save()
+
+
+def make_library(libdir, ntracks, formats, seed=0):
+    """Write ntracks tagged files (Artist/Album/NN - Title.ext) and the
+    library.m3u playlist of them, unless already there. Return the playlist
+    path."""
+    playlist = op.join(libdir, 'library.m3u')
+    manifest = op.join(libdir, 'library.json')
+    params = {'ntracks': ntracks, 'formats': formats, 'seed': seed}
+    if op.exists(manifest):
+        with open(manifest) as F:
+            if json.load(F) == params:
+                return playlist
+    rng = Random(seed)
+    templates = {}
+    tmpdir = tempfile.mkdtemp(prefix='bench-templates-')
+    try:
+        for ext in formats:
+            if ext in ('m4a', 'wma'):
+                templates[ext] = ffmpeg_template(ext, tmpdir)
+                if templates[ext] is None:
+                    print("ffmpeg not available: no %s files" % ext,
+                          file=sys.stderr)
+                    del templates[ext]
+    finally:
+        shutil.rmtree(tmpdir)
+    exts = [ext for ext in formats if ext in ('mp3', 'flac') or ext in templates]
+    with open(playlist, 'w') as M3U:
+        M3U.write('#EXTM3U\n')
+        for i in range(ntracks):
+            ext = exts[i % len(exts)]
+            artist = 'Artist %d' % (i // (TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST))
+            album = 'Album %d' % (i // TRACKS_PER_ALBUM)
+            number = i % TRACKS_PER_ALBUM + 1
+            title = 'Title %d' % i
+            path = op.join(libdir, artist, album,
+                           '%02d - %s.%s' % (number, title, ext))
+            if not op.isdir(op.dirname(path)):
+                os.makedirs(op.dirname(path))
+            with open(path, 'wb') as F:
+                if ext == 'mp3':
+                    F.write(MP3_FRAME * rng.randint(10, 60))
+                elif ext == 'flac':
+                    F.write(flac_stream(rng.randint(1, 5),
+                                        rng.randint(4096, 32768)))
+                else:
+                    F.write(templates[ext])
+            tag_file(path, ext, artist, album, title, number)
+            M3U.write('file://' + quote(path) + '\n')
+    with open(manifest, 'w') as F:
+        json.dump(params, F)
+    return playlist
+
+
+def measure(func, repeat=3, memory=True):
+    """Best time of `repeat` calls of func, and the peak of memory allocated
+    by Python during one more (traced) call."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run_sync(playlist, libdir, targetdir, jobs):
+    destdir = tempfile.mkdtemp(prefix='bench-sync-', dir=targetdir)
+    try:
+        coolsync.sync(playlist, destdir, localdirs=[libdir + os.sep],
+                      ignore_all=True, cache=False, jobs=jobs)
+    finally:
+        shutil.rmtree(destdir)
+
+
+def run_suite(playlist, libdir, targetdir, jobs=1, repeat=3, memory=True):
+    with open(playlist) as F:
+        paths = list(iter_playlist(F))
+    urlset = set(paths)
+    total = sum(op.getsize(path) for path in paths)
+    benchmarks = [
+        ('dir_audioscan', lambda: coolsync.dir_audioscan(libdir, None, jobs)),
+        ('readm3u', lambda: coolsync.readm3u(playlist)),
+        ('iter_playlist', lambda: list(iter_playlist(open(playlist)))),
+        ('get_playlist_filesize',
+         lambda: get_playlist_filesize(open(playlist))),
+        ('fixedsize_sample',
+         lambda: fixedsize_sample(urlset, total // 2, total // 1000)),
+        ('capacity_sample',
+         lambda: capacity_sample(urlset, total // 2, total // 1000, seed=0)),
+        ('sync', lambda: run_sync(playlist, libdir, targetdir, jobs)),
+    ]
+    results = {}
+    for name, func in benchmarks:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            seconds, peak = measure(func, repeat, memory)
+        results[name] = {'seconds': seconds, 'items': len(paths),
+                         'throughput': len(paths) / seconds if seconds else None,
+                         'peak_memory': peak}
+        print("%-22s %8.3f s %10.0f tracks/s  peak %10s" % (
+              name, seconds, results[name]['throughput'] or 0,
+              humanize_number(peak) if peak is not None else '-'))
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """Print the time ratios to the baseline. Return the names of the
+    benchmarks slower by more than threshold."""
+    regressions = []
+    print("%-22s %10s %10s %8s" % ('', 'baseline', 'now', 'ratio'))
+    for name in sorted(set(results) & set(baseline)):
+        before = baseline[name]['seconds']
+        after = results[name]['seconds']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif ratio < 1 - threshold:
+            flag = '  improvement'
+        print("%-22s %9.3fs %9.3fs %8.2f%s" % (name, before, after, ratio, flag))
+    return regressions
+
+
+def main(ntracks=10000, formats=['mp3', 'flac', 'm4a', 'wma'], libdir=None,
+         targetdir='/dev/shm', jobs=1, repeat=3, no_memory=False, output=None,
+         baseline=None, threshold=0.1):
+    tmplib = libdir is None
+    if tmplib:
+        libdir = tempfile.mkdtemp(prefix='bench-lib-')
+    elif not op.isdir(libdir):
+        os.makedirs(libdir)
+    try:
+        start = time.time()
+        playlist = make_library(libdir, ntracks, formats)
+        print("Library of %d tracks ready in %.1f s" % (ntracks,
+                                                         time.time() - start))
+        results = run_suite(playlist, libdir, targetdir, jobs, repeat,
+                            not no_memory)
+    finally:
+        if tmplib:
+            shutil.rmtree(libdir)
+    report = {'meta': {'ntracks': ntracks, 'formats': formats, 'jobs': jobs,
+                       'repeat': repeat, 'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'maxrss_kib': resource.getrusage(
+                           resource.RUSAGE_SELF).ru_maxrss if resource else None},
+              'results': results}
+    if output:
+        with open(output, 'w') as F:
+            json.dump(report, F, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as F:
+            regressions = compare(results, json.load(F)['results'], threshold)
+        if regressions:
+            return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--ntracks', type=int, default=10000,
+                        help='size of the library [%(default)s]')
+    parser.add_argument('-f', '--formats', nargs='+',
+                        default=['mp3', 'flac', 'm4a', 'wma'],
+                        choices=['mp3', 'flac', 'm4a', 'wma'],
+                        help='[%(default)s]')
+    parser.add_argument('-L', '--libdir',
+                        help='where to write the library, reused by later runs '
+                             'with the same parameters [temporary dir]')
+    parser.add_argument('-t', '--targetdir', default='/dev/shm',
+                        help='where to sync the library [%(default)s]')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='processes reading tags [%(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='keep the best of REPEAT runs [%(default)s]')
+    parser.add_argument('-M', '--no-memory', action='store_true',
+                        help='skip the traced run measuring peak memory')
+    parser.add_argument('-o', '--output', help='save the results to a JSON file')
+    parser.add_argument('-b', '--baseline',
+                        help='compare to the results saved in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression '
+                             '[%(default)s]')
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""Time of reading the tags of the synthetic library of bench_suite, by
+mutagen versus the fast reader of fasttags.py, per format. The records of
+both are checked to be the same."""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import fasttags
+from coolsync import mutagen_audiotags, read_audiotags
+from bench_suite import make_library
+from playlisttools import iter_playlist
+
+
+def best_time(read, paths, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for path in paths:
+            read(path)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(ntracks=2000, formats=['mp3', 'flac', 'm4a', 'wma'], libdir=None,
+         repeat=3):
+    tmplib = libdir is None
+    if tmplib:
+        libdir = tempfile.mkdtemp(prefix='bench-lib-')
+    elif not op.isdir(libdir):
+        os.makedirs(libdir)
+    try:
+        with open(make_library(libdir, ntracks, formats)) as F:
+            paths = list(iter_playlist(F))
+        byformat = {}
+        for path in paths:
+            byformat.setdefault(op.splitext(path)[1], []).append(path)
+        status = None
+        for ext, group in sorted(byformat.items()):
+            fast = 0
+            for path in group:
+                try:
+                    record = fasttags.read_tags(path)
+                except fasttags.Unsupported:
+                    continue
+                fast += 1
+                if record != mutagen_audiotags(path):
+                    print("Different records: %s" % path, file=sys.stderr)
+                    status = 1
+            t_mutagen = best_time(mutagen_audiotags, group, repeat)
+            t_fast = best_time(read_audiotags, group, repeat)
+            print("%-6s %5d files (%5d fast)  mutagen %7.3f s  read_audiotags "
+                  "%7.3f s  speedup x%.1f" % (ext, len(group), fast,
+                  t_mutagen, t_fast, t_mutagen / t_fast if t_fast else 0))
+    finally:
+        if tmplib:
+            shutil.rmtree(libdir)
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--ntracks', type=int, default=2000,
+                        help='size of the library [%(default)s]')
+    parser.add_argument('-f', '--formats', nargs='+',
+                        default=['mp3', 'flac', 'm4a', 'wma'],
+                        choices=['mp3', 'flac', 'm4a', 'wma'],
+                        help='[%(default)s]')
+    parser.add_argument('-L', '--libdir',
+                        help='library written by bench_suite.py, reused if '
+                             'it has the same parameters [temporary dir]')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='keep the best of REPEAT runs [%(default)s]')
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,204 @@
+"""
+Compact catalog of audio tracks, indexed by path and by tags.
+
+Replaces the `metadata` dict of dicts and the three-level `rmetadata` dict
+of sets: each track is a slotted Track object, and the artist/album strings
+shared by many tracks are interned.
+
+Duplicates are found with a second index, keyed by normalized tags (case,
+whitespace, Unicode normalization and '/' are ignored), optionally checking
+that durations match.
+"""
+
+from __future__ import print_function
+
+import re
+import unicodedata
+
+
+# Tag keys of coolsync patterns, and the matching Track attributes.
+TAGKEYS = (('a', 'artist'),
+           ('b', 'album'),
+           ('n', 'number'),
+           ('t', 'title'),
+           ('y', 'year'))
+ATTRS = dict(TAGKEYS)
+
+SPACES = re.compile(r'\s+', re.UNICODE)
+
+
+def normalize_tag(value):
+    """Comparable form of a tag: NFKC, case folded, '/' as '-' (as in
+    destination paths), whitespace collapsed."""
+    if value is None:
+        return ''
+    if not isinstance(value, type(u'')):
+        value = u'%s' % value
+    value = unicodedata.normalize('NFKC', value)
+    value = getattr(value, 'casefold', value.lower)()
+    return SPACES.sub(' ', value.replace('/', '-')).strip()
+
+
+def normalize_number(value):
+    """Track number as an int: '3/12', (3, 12) and 3 all give 3."""
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    try:
+        return int((u'%s' % value).split('/')[0].strip())
+    except ValueError:
+        return normalize_tag(value)
+
+
+class Track(object):
+    """Metadata of one audio file. Missing tags are None."""
+
+    __slots__ = ('path', 'artist', 'album', 'number', 'title', 'year',
+                 'bitrate', 'length', 'tagged')
+
+    def __init__(self, path, record, tagged=True, intern=None):
+        intern = intern or (lambda s: s)
+        self.path = path
+        self.artist = intern(record.get('a'))
+        self.album = intern(record.get('b'))
+        self.number = record.get('n')
+        self.title = record.get('t')
+        self.year = intern(record.get('y'))
+        self.bitrate = record.get('bitrate')
+        self.length = record.get('length')
+        self.tagged = tagged
+
+    def get(self, key, default=None):
+        """Value of a tag by its pattern key ('a', 'b', 'n', 't' or 'y'), or
+        of 'bitrate'/'length'."""
+        value = getattr(self, ATTRS.get(key, key))
+        return default if value is None else value
+
+    def tags(self):
+        """{key: value} of the tags present, e.g. to format a pattern."""
+        return dict((key, getattr(self, attr)) for key, attr in TAGKEYS
+                    if getattr(self, attr) is not None)
+
+    def record(self):
+        """The plain dict given by coolsync.read_audiotags."""
+        record = self.tags()
+        record['bitrate'] = self.bitrate
+        record['length'] = self.length
+        return record
+
+    def tagkey(self):
+        """Key of the track in the (artist, album, title) index."""
+        return ('unknown artist' if self.artist is None else self.artist,
+                'unknown album' if self.album is None else self.album,
+                'unknown track' if self.title is None else self.title)
+
+    def normkey(self):
+        """Key of the track in the normalized index."""
+        return (normalize_tag(self.artist), normalize_tag(self.album),
+                normalize_tag(self.title), normalize_number(self.number))
+
+    def __repr__(self):
+        return 'Track(%r, %r)' % (self.path, self.record())
+
+
+def index_add(index, key, path):
+    paths = index.get(key)
+    if paths is None:
+        index[key] = path
+    elif isinstance(paths, set):
+        paths.add(path)
+    else:
+        # Most keys have a single path: only then use a set.
+        index[key] = set((paths, path))
+
+
+def index_remove(index, key, path):
+    paths = index[key]
+    if isinstance(paths, set):
+        paths.discard(path)
+        if len(paths) == 1:
+            index[key] = paths.pop()
+    else:
+        del index[key]
+
+
+def index_get(index, key):
+    paths = index.get(key)
+    if paths is None:
+        return set()
+    if isinstance(paths, set):
+        return set(paths)
+    return set((paths,))
+
+
+class Catalog(object):
+    """Tracks indexed by path and by (artist, album, title), and optionally
+    by normalized (artist, album, title, number) to find duplicates."""
+
+    def __init__(self, normalized=False):
+        self.tracks = {}
+        self.bytags = {}
+        self.bynormtags = {} if normalized else None
+        self.strings = {}
+
+    def intern(self, s):
+        try:
+            return self.strings.setdefault(s, s)
+        except TypeError:
+            # Not hashable (e.g. some mutagen tag values)
+            return s
+
+    def add(self, path, record, tagged=True):
+        """Add (or replace) the track of path, from its read_audiotags record.
+        Only tagged tracks are indexed by tags."""
+        if path in self.tracks:
+            self.remove(path)
+        track = Track(path, record, tagged, self.intern)
+        self.tracks[path] = track
+        if tagged:
+            index_add(self.bytags, track.tagkey(), path)
+            if self.bynormtags is not None:
+                index_add(self.bynormtags, track.normkey(), path)
+        return track
+
+    def remove(self, path):
+        track = self.tracks.pop(path)
+        if track.tagged:
+            index_remove(self.bytags, track.tagkey(), path)
+            if self.bynormtags is not None:
+                index_remove(self.bynormtags, track.normkey(), path)
+
+    def lookup(self, artist, album, title):
+        """Set of the paths of the tracks with these tags (may be empty)."""
+        return index_get(self.bytags, (artist, album, title))
+
+    def duplicates(self, track, tolerance=None):
+        """Set of the paths of the tracks with the same normalized tags as
+        track (from another catalog). With a tolerance in seconds, their
+        durations must also match."""
+        if self.bynormtags is None:
+            raise ValueError("Catalog built without the normalized index")
+        if not track.tagged or track.title is None:
+            return set()
+        paths = index_get(self.bynormtags, track.normkey())
+        if tolerance is not None and track.length is not None:
+            paths = set(path for path in paths
+                        if self.tracks[path].length is None or
+                        abs(self.tracks[path].length - track.length) <= tolerance)
+        return paths
+
+    def __getitem__(self, path):
+        return self.tracks[path]
+
+    def get(self, path, default=None):
+        return self.tracks.get(path, default)
+
+    def __contains__(self, path):
+        return path in self.tracks
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def __len__(self):
+        return len(self.tracks)
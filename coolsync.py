@@ -9,16 +9,38 @@ DESCRIPTION
     `artist/album/tracknb-title.ext`
 """
 
+from __future__ import print_function
+
 import os
 import errno   # symbolic codes for error types
 import os.path
 import sys
 import re
-import shutil
-import urllib
+import time
 import argparse
-import mutagen
-#import 
+
+import fasttags
+from tagcache import TagCache
+from catalog import Catalog
+from policies import Policy, ANSWERS
+from journal import Journal
+from destpaths import PathPlanner
+from snapshot import Snapshot
+from metrics import Metrics, Progress
+from transcode import Transcoder, parse_rules, output_extension, \
+                      estimate_size, check_encoder
+from syncplan import CATEGORIES, summarize, sort_operations, save_plan, load_plan
+from copyengine import CopyScheduler, FileCopier, FanoutCopier, \
+                       available_backends, remove_partial
+from playlisttools import humannumber2int, stat_paths
+
+try:
+    # Python3
+    from urllib.parse import unquote
+except ImportError:
+    # Python2
+    from urllib import unquote
+    input = raw_input
 
 # Steps
 # Load file list from .m3u
@@ -34,7 +56,7 @@ import mutagen
 # Copy files to be copied according to the pattern
 
 
-exts = ['mp3', 'ogg', 'flac', 'wma', 'm4a', 'wav']
+exts = ['mp3', 'ogg', 'flac', 'wma', 'm4a', 'wav', 'opus']
 
 short2long = {'a': 'artist',
               'b': 'album' ,
@@ -85,28 +107,44 @@ wmatags = {'artist': 'Author',
            'year'  : 'WM/Year',
            'y'     : 'WM/Year'}
 wmatags_set = set(wmatags.values())
+vorbistags = {'artist': 'artist',
+              'a'     : 'artist',
+              'album' : 'album',
+              'b'     : 'album',
+              'number': 'tracknumber',
+              'n'     : 'tracknumber',
+              'title' : 'title',
+              't'     : 'title',
+              'year'  : 'date',
+              'y'     : 'date'}
 
 
-def readm3u(playlistfile):
-    """Return the set of files of the playlist, and its size in bytes"""
-    fileset = set()
-    s = 0  # total size of files
-    nf = 0 # number of files not found
+def readm3u(playlistfile, sizes=None, threads=0, mtimes=None, missing=None):
+    """Return the set of files of the playlist, and its size in bytes.
+    The size (and mtime) of each found file is stored in the `sizes` (and
+    `mtimes`) dict if given, and the files not found in the `missing` list."""
+    paths = []
     with open(playlistfile) as F:
         for line in F.readlines():
             if not line.startswith('#'):
-                path = urllib.unquote(line.rstrip().replace('file://', ''))
-                fileset.add(path)
-                try:
-                    s += os.path.getsize(path)
-                except OSError:
-                    print >>sys.stderr, "Not found: %r" % path
-                    nf += 1
+                paths.append(unquote(line.rstrip().replace('file://', '')))
+    fileset = set(paths)
+    found = stat_paths(fileset, threads, mtimes)
+    if sizes is not None:
+        sizes.update(found)
+    s = sum(found.values())  # total size of files
+    nf = 0 # number of files not found
+    for path in paths:
+        if path not in found:
+            print("Not found: %r" % path, file=sys.stderr)
+            nf += 1
+            if missing is not None:
+                missing.append(path)
     ntot = len(fileset)
     bytesize = make_human_bytesize(s)
     readablesize = make_readable_number(s)
 
-    print "%d/%d files: %s (%s)" %(ntot - nf, ntot, bytesize, readablesize)
+    print("%d/%d files: %s (%s)" %(ntot - nf, ntot, bytesize, readablesize))
     return fileset, s
 
 
@@ -125,14 +163,20 @@ def make_readable_number(s):
 def make_human_bytesize(s, precision=1):
     power = 0
     units = ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']
-    while s / 1024**(power+1):
+    while s // 1024**(power+1):
         power += 1
     bytesize = "%4.*f %sB" % (precision, float(s) / 1024**power, units[power])
     return bytesize
 
 
+def roundup(size, cluster):
+    """Space taken by a file on a filesystem allocating `cluster` bytes at a
+    time."""
+    return -(-size // cluster) * cluster
+
+
 def make_minutes(t):
-    m = int(t) / 60
+    m = int(t) // 60
     s = int(t) % 60
     return "%s min %s s" % (m,  s)
 
@@ -152,16 +196,31 @@ def pattern2python(pattern):
     return ppattern.replace('{n}', '{n:0>2s}')
 
 
-def file_audioscan(f, metadata, rmetadata):
+def read_audiotags(f):
+    """Return the metadata record of an audio file, and whether it is tagged.
+    The needed fields are parsed directly when possible (see fasttags.py),
+    otherwise by mutagen."""
+    try:
+        return fasttags.read_tags(f)
+    except fasttags.Unsupported:
+        return mutagen_audiotags(f)
+
+
+def mutagen_audiotags(f):
+    """read_audiotags, by mutagen."""
+    # Imported on the first use, as fasttags reads most files.
+    import mutagen
     audiofile = mutagen.File(f)
-    metadata[f] = {}
-    metadata[f]['bitrate'] = audiofile.info.bitrate
-    metadata[f]['length'] = audiofile.info.length
+    if audiofile is None:
+        raise ValueError("unknown audio format: %s" % f)
+    record = {}
+    record['bitrate'] = audiofile.info.bitrate
+    record['length'] = audiofile.info.length
     try:
         tagkeys = set(audiofile.tags.keys())
     except AttributeError:
         # File not tagged.
-        return
+        return record, False
     # gather audio tags
     if f.endswith('.mp3') or f.endswith('.MP3'):
         tags = id3tags
@@ -170,207 +229,1061 @@ def file_audioscan(f, metadata, rmetadata):
             #raise NotImplementedError("unrecognized tags: %s" % f)
         for k in 'abnty': #y caused trouble
             try:
-                metadata[f][k] = audiofile[tags[k]].text[0]
-            except KeyError, e:
+                record[k] = audiofile[tags[k]].text[0]
+            except KeyError as e:
                 pass # handled later using .get()
     elif f.endswith('.m4a'):
         tags = m4atags
         for k in 'abnty': #y caused trouble
             try:
-                metadata[f][k] = audiofile[tags[k]][0]
+                record[k] = audiofile[tags[k]][0]
             except KeyError:
                 pass
-                #print >>sys.stderr, "tag not found %s: %s" % \
-                #                        (k, tags[k])
-    elif f.endswith('.wma'):
-        tags = wmatags
-        for k in 'at':
+                #print("tag not found %s: %s" % \
+                #                        (k, tags[k]), file=sys.stderr)
+    elif f.endswith('.flac') or f.endswith('.ogg') or f.endswith('.opus'):
+        tags = vorbistags
+        for k in 'abnty':
             try:
-                metadata[f][k] = audiofile[tags[k]][0]
+                record[k] = audiofile[tags[k]][0]
             except KeyError:
                 pass
-        for k in 'bny':
+    elif f.endswith('.wma'):
+        tags = wmatags
+        for k in 'abnty':
             try:
-                metadata[f][k] = audiofile[tags[k]][0].value
+                record[k] = audiofile[tags[k]][0].value
             except KeyError:
                 pass
     else:
         raise NotImplementedError("unimplemented tag formats: %s" % f )
-    # associate tags to filename for reverse search
+    return record, True
+
+
+def timed_audiotags(f):
+    """read_audiotags(f), and the time it took."""
+    start = time.time()
+    result = read_audiotags(f)
+    return result, time.time() - start
+
+
+def checked_audiotags(f):
+    """timed_audiotags(f) and None, or None and the error reading f."""
     try:
-        artist = rmetadata.setdefault(metadata[f].get('a', 'unknown artist'), {})
-        album = artist.setdefault(metadata[f].get('b', 'unknown album'), {})
-        title = album.setdefault(metadata[f].get('t', 'unknown track'), set())
-        title.add(f)
-    except (KeyError, TypeError):
-        print >>sys.stderr, f, metadata[f]
-        raise
-
-
-def dir_audioscan(destdir):
-    """Build list of tracks and associated metadata in a directory.
-    WARNING: Have no idea how many files it can handle without crashing"""
+        return timed_audiotags(f), None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def file_audioscan(f, catalog, cache=None, metrics=None):
+    """Read the tags of f (or take them from the cache) into the catalog."""
+    if cache is not None:
+        st = os.stat(f)
+        cached = cache.get(f, st)
+    else:
+        cached = None
+    if cached is None:
+        (record, tagged), seconds = timed_audiotags(f)
+        if metrics is not None:
+            metrics.count('parse tags', seconds)
+        if cache is not None:
+            cache.put(f, record, tagged, st)
+    else:
+        record, tagged = cached
+    return catalog.add(f, record, tagged)
+
+
+def scan_audiofiles(paths, catalog, cache=None, jobs=1, metrics=None,
+                    errors=None):
+    """Scan several files with file_audioscan, reading the tags that are not
+    cached with `jobs` worker processes. The result does not depend on jobs.
+    The time spent reading tags is counted in metrics.
+    If `errors` is a list, the files that cannot be read are not added to
+    the catalog but to errors, as (path, reason), instead of raising."""
+    if jobs <= 1:
+        for f in paths:
+            if errors is None:
+                file_audioscan(f, catalog, cache, metrics)
+                continue
+            try:
+                file_audioscan(f, catalog, cache, metrics)
+            except Exception as e:
+                errors.append((f, '%s: %s' % (type(e).__name__, e)))
+        return
+    records = {}
+    stats = {}
+    missing = []
+    for f in paths:
+        if cache is not None:
+            stats[f] = os.stat(f)
+            cached = cache.get(f, stats[f])
+            if cached is not None:
+                records[f] = cached
+                continue
+        missing.append(f)
+    if missing:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            chunksize = max(1, len(missing) // (jobs * 16))
+            read = timed_audiotags if errors is None else checked_audiotags
+            for f, result in zip(missing, pool.imap(read, missing,
+                                                    chunksize)):
+                if errors is not None:
+                    result, error = result
+                    if error is not None:
+                        errors.append((f, error))
+                        continue
+                result, seconds = result
+                records[f] = result
+                if metrics is not None:
+                    metrics.count('parse tags', seconds)
+                if cache is not None:
+                    cache.put(f, result[0], result[1], stats[f])
+        finally:
+            pool.close()
+            pool.join()
+    # Merge in the input order, as the serial scan does.
+    for f in paths:
+        if f not in records:
+            continue
+        record, tagged = records[f]
+        catalog.add(f, record, tagged)
+
+
+def dir_audioscan(destdir, cache=None, jobs=1, metrics=None):
+    """Build the catalog of the tracks in a directory, with the normalized
+    index used to find duplicates."""
     # Warning: files with same name but different tags?
-    metadata = {}
-    rmetadata = {}
+    catalog = Catalog(normalized=True)
     reg = re.compile(r'\.(' + r'|'.join(exts) + ')$')
-    for root, _, files in os.walk(destdir):
-        for f in files:
-            if reg.search(f):
-                file_audioscan(os.path.join(root, f), metadata, rmetadata)
-    return metadata, rmetadata
+    paths = [os.path.join(root, f) for root, _, files in os.walk(destdir)
+                                   for f in files if reg.search(f)]
+    scan_audiofiles(paths, catalog, cache, jobs, metrics)
+    if cache is not None:
+        cache.retain(catalog)
+        cache.commit()
+    return catalog
 
 
-def sync(playlistfile, destdir, pattern="%a/%b/%n-%t", localdirs=["~/Musique/"],
-         ignore_all=False):
+def destination_path(track, ppattern, destdir, localregs, localdirs):
+    """Path of the copy of a track according to its tags, or to its path
+    relative to the matching local directory if it is not fully tagged."""
+    f = track.path
+    fields = track.tags()
+    a = fields.get('a')
+    b = fields.get('b')
+    t = fields.get('t')
+    n = fields.get('n')
+    _, ext = os.path.splitext(f)
+    if all((a, b, t, n)):
+        fields['a'] = a.replace('/', '-').rstrip()
+        fields['b'] = b.replace('/', '-').rstrip()
+        fields['t'] = t.replace('/', '-').rstrip()
+        if isinstance(n, tuple):
+            # m4a: (number, total)
+            n = n[0]
+        fields['n'] = str(n).replace('/', '-').rstrip()
+        try:
+            destf = os.path.join(destdir, ppattern.format(**fields)) + ext
+        except UnicodeEncodeError:
+            for k in 'abtn':
+                fields[k] = fields[k].encode('utf8')
+            destf = os.path.join(destdir, ppattern.format(**fields)) + ext
+    else:
+        i = 0
+        while i <= len(localregs) and not localregs[i].match(f):
+            i += 1
+        try:
+            destsubdirs = localregs[i].sub('', f)
+        except IndexError:
+            print("No matching localdir for %s, %s" % \
+                    (f, localdirs), file=sys.stderr)
+        destf = os.path.join(destdir, destsubdirs) + ext
+    return destf
+
+
+def ask_conflict(src, dst, same_name):
+    """Interactive conflict resolution (the 'ask' rule of policies)."""
+    print("Warning: Song %s - %s (%s)" % (src.get('a', '?'), src.get('t', '?'),
+                                          src.get('b', '?')), file=sys.stderr)
+    print("already exists in destination.", file=sys.stderr)
+    dbr = str(dst.bitrate // 1000) + ' kbps'
+    dle = make_minutes(dst.length)
+    lbr = str(src.bitrate // 1000) + ' kbps'
+    lle = make_minutes(src.length)
+    print("Replace %s (%s, %s)" % (dst.path, dbr, dle), file=sys.stderr)
+    print("by %s (%s, %s) ?" % (src.path, lbr, lle), file=sys.stderr)
+    answer = ''
+    if same_name:
+        while answer not in ['r', 'i']:
+            answer = input("Replace (r) / Ignore (i) : ")
+    else:
+        while answer not in ['r', 'c', 'i']:
+            answer = input("Replace (r) / Ignore (i) / Copy alongside (c): ")
+    return answer
+
+
+def same_name(df, destf):
+    """Replacing a track by a file of the same name means copying over it
+    (or next to it)."""
+    return os.path.split(df)[1] == os.path.split(destf)[1]
+
+
+def resolve_conflicts(plan, lcatalog, dcatalog, policy):
+    """Decide what to do with every existing track of the plan, before
+    copying anything. Return {f: [(df, answer, rule), ...]}."""
+    decisions = {}
+    for f, destf, dfset in plan:
+        for df in sorted(dfset):
+            answer, rule = policy.decide(lcatalog[f], dcatalog[df],
+                                         same_name(df, destf))
+            decisions.setdefault(f, []).append((df, answer, rule))
+    return decisions
+
+
+def report_decisions(decisions, report=None):
+    """Print the number of decisions per answer and rule, and write them all
+    to the report file if given."""
+    counts = {}
+    for f in sorted(decisions):
+        for df, answer, rule in decisions[f]:
+            key = (ANSWERS[answer], rule)
+            counts[key] = counts.get(key, 0) + 1
+    for (answer, rule), n in sorted(counts.items()):
+        print("  %-10s %6d (%s)" % (answer, n, rule), file=sys.stderr)
+    if report:
+        with open(report, 'w') as F:
+            F.write("decision\trule\tsource\tdestination\n")
+            for f in sorted(decisions):
+                for df, answer, rule in decisions[f]:
+                    F.write("%s\t%s\t%s\t%s\n" % (ANSWERS[answer], rule, f, df))
+
+
+def plan_operations(plan, decisions, sizes, cluster, encodes=None):
+    """Operations applying the (f, destf, dfset) items of the plan (see
+    syncplan): 'remove' existing tracks replaced by others, then 'copy' the
+    playlist track, or 'skip' it if it is already present. Copies and skips
+    are sorted into categories, with the space they take and free on the
+    destination, in clusters:
+
+        new:       copied to a free path;
+        overwrite: copied over an untracked file at the same path;
+        replace:   replaces existing tracks with the same tags (dfset);
+        alongside: copied next to existing tracks with the same tags;
+        present:   same tags as existing tracks, ignored.
+
+    Tracks of `encodes` ({f: (format, quality, tags)}) are transcoded, and
+    take their estimated encoded size."""
+    encodes = encodes or {}
+    ops = []
+    for f, destf, dfset in plan:
+        op = {'op': 'copy', 'src': f, 'dst': destf, 'size': sizes[f],
+              'bytes': roundup(sizes[f], cluster), 'freed': 0}
+        if f in encodes:
+            fmt, quality, tags, estimate = encodes[f]
+            op['transcode'] = {'format': fmt, 'quality': quality, 'tags': tags}
+            op['bytes'] = roundup(estimate, cluster)
+        answers = decisions.get(f, [])
+        if answers:
+            op['conflicts'] = [{'dst': df, 'decision': ANSWERS[answer],
+                                'rule': rule} for df, answer, rule in answers]
+            removed = [df for df, answer, _ in answers
+                       if df == destf and answer != 'i' or
+                          answer == 'r' and not same_name(df, destf)]
+            if all(answer == 'i' for _, answer, _ in answers):
+                op.update(op='skip', category='present', bytes=0)
+            elif removed:
+                op['category'] = 'replace'
+                op['freed'] = sum(roundup(os.path.getsize(df), cluster)
+                                  for df in removed)
+                for df, answer, _ in answers:
+                    if answer == 'r' and not same_name(df, destf):
+                        ops.append({'op': 'remove', 'dst': df})
+            else:
+                op['category'] = 'alongside'
+        elif os.path.exists(destf):
+            op['category'] = 'overwrite'
+            op['freed'] = roundup(os.path.getsize(destf), cluster)
+        else:
+            op['category'] = 'new'
+        ops.append(op)
+    return ops
+
+
+def mirror_operations(ops, dcatalog, cluster, key=None, keep=()):
+    """Removals of the destination tracks that the operations do not cover:
+    neither copied over, nor kept as the existing copy of a playlist track,
+    nor in `keep`. Paths are compared by `key` (e.g. case-insensitively)."""
+    key = key or (lambda path: path)
+    covered = set(key(path) for path in keep)
+    for op in ops:
+        if op['op'] == 'remove':
+            continue
+        covered.add(key(op['dst']))
+        covered.update(key(conflict['dst'])
+                       for conflict in op.get('conflicts', [])
+                       if conflict['decision'] != 'replace')
+    return [{'op': 'remove', 'dst': df, 'category': 'stale', 'bytes': 0,
+             'freed': roundup(os.path.getsize(df), cluster)}
+            for df in sorted(dcatalog) if key(df) not in covered]
+
+
+def prune_empty_dirs(dirs, destdir):
+    """Remove the empty directories among dirs and their parents, up to
+    destdir (excluded)."""
+    destdir = os.path.abspath(destdir)
+    # Deepest first, so that parents emptied by the pruning are removed too.
+    todo = set()
+    for d in dirs:
+        d = os.path.abspath(d)
+        while d.startswith(destdir + os.sep):
+            todo.add(d)
+            d = os.path.dirname(d)
+    pruned = 0
+    for d in sorted(todo, key=lambda d: d.count(os.sep), reverse=True):
+        try:
+            os.rmdir(d)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                raise
+        else:
+            pruned += 1
+    return pruned
+
+
+def print_plan_summary(summary, cluster):
+    print("Transfer plan (cluster size: %s):" % make_human_bytesize(cluster).lstrip(),
+          file=sys.stderr)
+    for category in CATEGORIES:
+        nfiles, written, freed = summary[category]
+        if not nfiles:
+            continue
+        line = "  %-10s %6d files %12s" % (category, nfiles,
+                                            make_human_bytesize(written))
+        if freed:
+            line += " (frees %s)" % make_human_bytesize(freed).lstrip()
+        print(line, file=sys.stderr)
+
+
+def read_playlist(playlistfile, stat_threads=0, metrics=None, missing=None):
+    """Return the sizes {path: bytes} and mtimes {path: mtime} of the found
+    files of the playlist. The others are added to the `missing` list."""
+    metrics = metrics or Metrics()
+    print("Reading playlist", file=sys.stderr)
+    sizes, mtimes = {}, {}
+    with metrics.phase('read playlist') as phase:
+        readm3u(playlistfile, sizes, stat_threads, mtimes, missing)
+        phase['files'] = len(sizes)
+        phase['bytes'] = sum(sizes.values())
+    return sizes, mtimes
+
+
+def read_tags(paths, cache=True, jobs=1, metrics=None, errors=None):
+    """Catalog of the playlist entries (paths). See scan_audiofiles for
+    `errors`."""
+    metrics = metrics or Metrics()
+    # Tags of the playlist entries are cached in the user cache directory.
+    lcache = TagCache(os.sep) if cache else None
+    print("Reading tags...", file=sys.stderr)
+    lcatalog = Catalog()
+    with metrics.phase('read tags') as phase:
+        scan_audiofiles(sorted(paths), lcatalog, lcache, jobs, metrics,
+                        errors)
+        phase['files'] = len(lcatalog)
+    if lcache is not None:
+        lcache.close()
+        print(lcache.stats(), file=sys.stderr)
+    return lcatalog
+
+
+def plan_destination(destdir, sizes, lcatalog, pattern="%a/%b/%n-%t",
+                     localdirs=["~/Musique/"], ignore_all=False, cache=True,
+                     jobs=1, tolerance=None, policy=None, report=None,
+                     mirror=False, fs_rules='auto', transcode=None,
+                     metrics=None, snapshot=None, changes=None):
+    """Scan the destination and resolve the conflicts with the scanned
+    playlist, without touching the destination. Return the operations of the
+    sync (see plan_operations) and the catalog of the destination.
+    Destination paths follow the naming rules of the destination filesystem
+    (see destpaths). Tracks matching the transcode rules are planned with
+    their encoded size. In mirror mode, the operations start with the
+    removal of the destination tracks not in the playlist. Each step is
+    timed in metrics.
+
+    With a loaded snapshot, the destination is not scanned, and only the
+    entries added or changed since (`changes`, from Snapshot.diff) are
+    planned."""
+    metrics = metrics or Metrics()
     localregs = [re.compile(r'^' + os.path.expanduser(L)) for L in localdirs]
     ppattern = pattern2python(pattern)
-    statvfs = os.statvfs(destdir)
-    avail = statvfs.f_bfree * statvfs.f_frsize  # available space
-    total = statvfs.f_blocks * statvfs.f_frsize # total size of filesystem
-    print >>sys.stderr, "Scanning destination..."
-    dmetadata, drmetadata = dir_audioscan(destdir)
-    print >>sys.stderr, "Reading playlist"
-    fileset, s = readm3u(playlistfile)
-    # TODO: update s depending on already existing files in destination
-    if s >= avail:
-        hs = make_human_bytesize(s)
-        ha = make_human_bytesize(avail)
-        print >>sys.stderr, "Warning: %s to transfer VS free space: %s" % (hs, ha)
-        answer = ''
-        while answer not in ['a', 'c']:
-            answer = raw_input("What to do? Abort (a) or copy until full (c): ")
-        if answer == 'a':
-            return 1
+    keep = []
+    if snapshot is not None:
+        with metrics.phase('load snapshot') as phase:
+            dcatalog = snapshot.catalog()
+            phase['files'] = len(dcatalog)
+        added, changed, removed = changes
+        print("Snapshot of %s: %d added, %d changed, %d removed entries" %
+              (destdir, len(added), len(changed), len(removed)),
+              file=sys.stderr)
+        for src, (_, _, dst) in snapshot.entries.items():
+            if src in changed:
+                # Copied again, instead of being a duplicate of its old copy.
+                if dst in dcatalog:
+                    dcatalog.remove(dst)
+            elif src not in removed:
+                keep.append(dst)
+        sizes = dict((src, sizes[src]) for src in added | changed)
+    else:
+        # Tags of the destination are cached on the device itself.
+        dcache = TagCache(destdir) if cache else None
+        print("Scanning destination %s..." % destdir, file=sys.stderr)
+        with metrics.phase('scan destination') as phase:
+            dcatalog = dir_audioscan(destdir, dcache, jobs, metrics)
+            phase['files'] = len(dcatalog)
+        if dcache is not None:
+            dcache.close()
+            print(dcache.stats(), file=sys.stderr)
 
-    print >>sys.stderr, "Copying files..."
-    lmetadata, lrmetadata = {}, {}
-    for f in sorted(list(fileset)):
-        file_audioscan(f, lmetadata, lrmetadata)
-        a = lmetadata[f].get('a')
-        b = lmetadata[f].get('b')
-        t = lmetadata[f].get('t')
-        n = lmetadata[f].get('n')
-        _, ext = os.path.splitext(f)
-        if all((a, b, t, n)):
-            lmetadata[f]['a'] = a.replace('/', '-').rstrip()
-            lmetadata[f]['b'] = b.replace('/', '-').rstrip()
-            lmetadata[f]['t'] = t.replace('/', '-').rstrip()
-            lmetadata[f]['n'] = str(n).replace('/', '-').rstrip()
-            try:
-                destf = os.path.join(destdir, ppattern.format(**lmetadata[f])) + ext
-            except UnicodeEncodeError:
-                for k in 'abtn':
-                    lmetadata[f][k] = lmetadata[f][k].encode('utf8')
-                destf = os.path.join(destdir, ppattern.format(**lmetadata[f])) + ext
+    with metrics.phase('plan') as phase:
+        ops = plan_sync(destdir, sizes, lcatalog, dcatalog, ppattern,
+                        localregs, localdirs, ignore_all, tolerance, policy,
+                        report, mirror, fs_rules, transcode, keep)
+        phase['files'] = len(ops)
+    if snapshot is not None:
+        # Old copies of the changed entries, not overwritten by the new ones.
+        planned = set(op['dst'] for op in ops)
+        ops = [{'op': 'remove', 'dst': dst}
+               for src, (_, _, dst) in sorted(snapshot.entries.items())
+               if src in changed and dst not in planned and
+                  os.path.exists(dst)] + ops
+    return ops, dcatalog
+
+
+def plan_sync(destdir, sizes, lcatalog, dcatalog, ppattern, localregs,
+              localdirs, ignore_all=False, tolerance=None, policy=None,
+              report=None, mirror=False, fs_rules='auto', transcode=None,
+              keep=()):
+    """The operations of plan_destination, from the catalogs. In mirror
+    mode, the destination tracks in `keep` are not removed either."""
+    planner = PathPlanner(destdir, fs_rules)
+    rules = parse_rules(transcode or [])
+    encodes = {}
+    plan = []
+    for f in sorted(sizes):
+        track = lcatalog[f]
+        destf = destination_path(track, ppattern, destdir, localregs,
+                                 localdirs)
+        ext = os.path.splitext(f)[1].lower()
+        if ext in rules:
+            fmt, quality = rules[ext]
+            destf = os.path.splitext(destf)[0] + output_extension(fmt)
+            encodes[f] = (fmt, quality, track.tags(),
+                          estimate_size(track.length, fmt, quality))
+        destf = planner.plan(destf, f)
+        plan.append((f, destf, dcatalog.duplicates(track, tolerance)))
+    for f, destf in planner.collisions:
+        print("Name already planned, renamed: %s -> %s" % (f, destf),
+              file=sys.stderr)
+
+    if ignore_all:
+        policy = Policy(['ignore'])
+    else:
+        policy = Policy(policy or ['ask'], ask=ask_conflict)
+    decisions = resolve_conflicts(plan, lcatalog, dcatalog, policy)
+    if decisions:
+        print("Conflicts:", file=sys.stderr)
+        report_decisions(decisions, report)
+
+    cluster = os.statvfs(destdir).f_frsize
+    ops = plan_operations(plan, decisions, sizes, cluster, encodes)
+    if mirror:
+        ops = mirror_operations(ops, dcatalog, cluster, planner.key,
+                                keep) + ops
+    return ops
+
+
+def sync(playlistfile, destdir, pattern="%a/%b/%n-%t", localdirs=["~/Musique/"],
+         ignore_all=False, cache=True, jobs=1, copy_jobs=4,
+         max_inflight=256 * 1024**2, copy_backend='auto', bufsize=8 * 1024**2,
+         preallocate=True, fsync_batch=0, stat_threads=0, tolerance=None,
+         policy=None, report=None, resume=False, plan_only=None, apply=False,
+         sort_destination=False, mirror=False, fs_rules='auto',
+         transcode=None, transcode_jobs=0, metrics_file=None, budget=None,
+         full_scan=False, verify=False, verify_jobs=4):
+    """Plan the sync of the playlist to destdir and execute it. With
+    plan_only, save the plan to this file instead. With apply, playlistfile
+    is a plan saved by plan_only. With mirror, the destination tracks that
+    are not in the playlist are deleted first. Tracks matching the
+    transcode rules (see transcode.py) are encoded by transcode_jobs
+    processes (default: one per CPU).
+
+    destdir can be a list of destinations, synced together: the playlist is
+    scanned once, and each source file is read once for all the
+    destinations needing it. pattern and budget (the maximum bytes written,
+    None for the free space) are then either single values or lists with
+    one value per destination.
+
+    A snapshot of the synced playlist is saved on each destination (see
+    snapshot.py): the next runs only read the tags of the entries added or
+    changed since, without scanning the destination, unless full_scan.
+
+    With verify, the copies are read back from the destination and compared
+    to their sources by verify_jobs threads, and copied again if they
+    differ.
+
+    The timings of the run are printed at the end, and saved as JSON to
+    metrics_file if given."""
+    destdirs = destdir if isinstance(destdir, (list, tuple)) else [destdir]
+    patterns = per_destination(pattern, len(destdirs), 'patterns')
+    budgets = per_destination(budget, len(destdirs), 'budgets')
+    if len(destdirs) > 1 and (plan_only or apply):
+        raise ValueError("Plans are saved and applied for one destination")
+    metrics = Metrics()
+    try:
+        return run_sync(playlistfile, destdirs, patterns, localdirs,
+                        ignore_all, cache, jobs, copy_jobs, max_inflight,
+                        copy_backend, bufsize, preallocate, fsync_batch,
+                        stat_threads, tolerance, policy, report, resume,
+                        plan_only, apply, sort_destination, mirror, fs_rules,
+                        transcode, transcode_jobs, budgets, full_scan,
+                        verify, verify_jobs, metrics)
+    finally:
+        metrics.report()
+        if metrics_file:
+            metrics.save(metrics_file)
+
+
+def per_destination(value, n, name):
+    """List of n values, from a single value or a list of n values (or of a
+    single one)."""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    if len(values) == 1:
+        return list(values) * n
+    if len(values) != n:
+        raise ValueError("%d %s given for %d destinations" % (len(values),
+                                                               name, n))
+    return list(values)
+
+
+def run_sync(playlistfile, destdirs, patterns, localdirs, ignore_all, cache,
+             jobs, copy_jobs, max_inflight, copy_backend, bufsize, preallocate,
+             fsync_batch, stat_threads, tolerance, policy, report, resume,
+             plan_only, apply, sort_destination, mirror, fs_rules, transcode,
+             transcode_jobs, budgets, full_scan, verify, verify_jobs,
+             metrics):
+    journals = [Journal(destdir) for destdir in destdirs]
+    plans = [None] * len(destdirs)
+    for i, journal in enumerate(journals):
+        if journal.exists() and not plan_only:
+            for path in journal.cleanup():
+                print("Removed partial copy: %s" % path, file=sys.stderr)
+            if resume:
+                plans[i] = journal.pending()
+                print("Resuming the interrupted sync of %s: %d operations "
+                      "left" % (journal.destdir, len(plans[i])),
+                      file=sys.stderr)
+                journal.reopen()
+                continue
+            print("Warning: the previous sync of %s was interrupted (see "
+                  "--resume), starting over." % journal.destdir,
+                  file=sys.stderr)
+        elif resume:
+            print("No interrupted sync of %s to resume, running a full sync."
+                  % journal.destdir, file=sys.stderr)
+
+    snapshots = [None] * len(destdirs)
+    changes = [None] * len(destdirs)
+    settings = [snapshot_settings(pattern, localdirs, fs_rules, transcode,
+                                  tolerance) for pattern in patterns]
+    sizes = mtimes = lcatalog = None
+    missing = []
+    if not apply and not all(plan is not None for plan in plans):
+        sizes, mtimes = read_playlist(playlistfile, stat_threads, metrics,
+                                      missing)
+        if mirror and missing:
+            # Their copies on the destination would be deleted as stale.
+            print("Warning: %d playlist entries not found (unmounted "
+                  "library?): mirroring would delete their copies." %
+                  len(missing), file=sys.stderr)
+            answer = ''
+            while answer not in ['a', 's', 'm']:
+                answer = input("What to do? Abort (a), sync without deleting "
+                               "(s) or mirror anyway (m): ")
+            if answer == 'a':
+                return 1
+            mirror = answer == 'm'
+        # Plans saved by plan_only are not based on snapshots.
+        tagged = None if full_scan or plan_only else set()
+        for i, destdir in enumerate(destdirs):
+            if plans[i] is not None or full_scan or plan_only:
+                continue
+            snapshots[i] = snapshot = Snapshot(destdir)
+            if not snapshot.load(settings[i]):
+                print("Full scan of %s: %s" % (destdir, snapshot.reason),
+                      file=sys.stderr)
+                tagged = None
+                continue
+            changes[i] = snapshot.diff(sizes, mtimes, missing)
+            if tagged is not None:
+                tagged.update(changes[i][0] | changes[i][1])
+        # Only the tags of the entries added or changed since the snapshots
+        # are needed, unless a destination is scanned in full.
+        lcatalog = read_tags(sizes if tagged is None else tagged, cache, jobs,
+                             metrics)
+
+    allops = [None] * len(destdirs)
+    dcatalogs = [None] * len(destdirs)
+    new = []
+    for i, destdir in enumerate(destdirs):
+        if plans[i] is not None:
+            continue
+        statvfs = os.statvfs(destdir)
+        avail = statvfs.f_bfree * statvfs.f_frsize  # available space
+        cluster = statvfs.f_frsize
+        if apply:
+            ops = load_plan(playlistfile, destdir)
         else:
-            i = 0
-            while i <= len(localregs) and not localregs[i].match(f):
-                i += 1
-            try:
-                destsubdirs = localregs[i].sub('', f)
-            except IndexError:
-                print >>sys.stderr, "No matching localdir for %s, %s" % \
-                        (f, localdirs)
-            destf = os.path.join(destdir, destsubdirs) + ext
-        dfset = drmetadata.get(a, {}).get(b, {}).get(t)
-        if dfset:
-            if not ignore_all:
-                for df in dfset:
-                    print >>sys.stderr, "Warning: Song {a} - {t} ({b})".\
-                                                        format(**lmetadata[f])
-                    print >>sys.stderr, "already exists in destination."
-                    dbr = str(dmetadata[df]['bitrate'] / 1000) + ' kbps'
-                    dle = make_minutes(dmetadata[df]['length'])
-                    lbr = str(lmetadata[f]['bitrate'] / 1000) + ' kbps'
-                    lle = make_minutes(lmetadata[f]['length'])
-                    print >>sys.stderr, "Replace %s (%s, %s)" % (df, dbr, dle)
-                    print >>sys.stderr, "by %s (%s, %s) ?" % (f, lbr, lle)
-                    answer = ''
-                    if os.path.split(df)[1] == os.path.split(destf)[1]:
-                        while answer not in ['r', 'i']:
-                            answer = raw_input("Replace (r) / Ignore (i) : ")
-                        if answer == 'r': answer = 'c' # consistent behavior
-                    else:
-                        while answer not in ['r', 'c', 'i']:
-                            answer = raw_input("Replace (r) / Ignore (i) / Copy alongside (c): ")
-                    if answer != 'i':
-                        if answer == 'r':
-                            os.remove(df)
-                        try:
-                            os.makedirs(os.path.split(destf)[0])
-                        except OSError as e:
-                            #if e.errno != errno.EEXIST:
-                                #print >>sys.stderr, e # Beware errno.EINVAL
-                                # TODO: try to use original path
-                                #raise
-                            if e.errno == errno.EINVAL:
-                                print >>sys.stderr, "Adapting file name: %s" % destf
-                                destf = destf.replace(':', '-').replace('?', '-')
-                                # recursively call the function
-                                try:
-                                    os.makedirs(os.path.split(destf)[0])
-                                except OSError as e:
-                                    if e.errno != errno.EEXIST:
-                                        print >>sys.stderr, e # Beware errno.EINVAL
-                        try:
-                            shutil.copy2(f, destf)
-                        except IOError as e:
-                            if e.errno == errno.ENOSPC:
-                                # "No space left on device"
-                                print >>sys.stderr, "Could not copy %s (%s)" % \
-                                        (f, e.strerror)
-                                os.remove(destf)
-                                return
-                            else:
-                                raise
+            t0 = time.time()
+            ops, dcatalogs[i] = plan_destination(
+                    destdir, sizes, lcatalog, patterns[i], localdirs,
+                    ignore_all, cache, jobs, tolerance, policy, report, mirror,
+                    fs_rules, transcode, metrics,
+                    snapshots[i] if changes[i] is not None else None,
+                    changes[i])
+            print("Plan computed in %.2f s" % (time.time() - t0),
+                  file=sys.stderr)
+
+        if len(destdirs) > 1:
+            print("%s:" % destdir, file=sys.stderr)
+        summary = summarize(ops)
+        print_plan_summary(summary, cluster)
+        if plan_only:
+            save_plan(ops, destdir, plan_only)
+            print("Plan saved to %s (%d operations)" % (plan_only, len(ops)),
+                  file=sys.stderr)
+            return
+
+        needed = sum(counts[1] - counts[2] for counts in summary.values())
+        if budgets[i] is not None and budgets[i] < avail:
+            if needed >= budgets[i]:
+                print("%s to transfer VS budget: %s, copying until the budget "
+                      "is reached." % (make_human_bytesize(needed),
+                                       make_human_bytesize(budgets[i])),
+                      file=sys.stderr)
+        elif needed >= avail:
+            hs = make_human_bytesize(needed)
+            ha = make_human_bytesize(avail)
+            print("Warning: %s to transfer VS free space: %s" % (hs, ha), file=sys.stderr)
+            answer = ''
+            while answer not in ['a', 'c']:
+                answer = input("What to do? Abort (a) or copy until full (c): ")
+            if answer == 'a':
+                return 1
+
+        allops[i] = ops
+        ops = [op for op in ops if op['op'] != 'skip']
+        if sort_destination:
+            ops = sort_operations(ops)
+        plans[i] = ops
+        new.append(i)
+
+    if any('transcode' in op for ops in plans for op in ops):
+        # Before the journals are written to the destinations.
+        try:
+            check_encoder()
+        except ValueError as e:
+            print("Error: %s" % e, file=sys.stderr)
+            return 1
+    for i in new:
+        journals[i].begin(plans[i])
+    skipped = [set() for _ in destdirs]
+    status = execute_operations(list(zip(journals, plans)), copy_jobs,
+                                max_inflight, copy_backend, bufsize,
+                                preallocate, fsync_batch, transcode_jobs,
+                                budgets, metrics, verify, verify_jobs, skipped)
+    for i in new:
+        # Only snapshot the destinations that were fully synced, from a
+        # scanned playlist (not an applied plan). Without a previous
+        # snapshot, the copies of missing entries are unknown.
+        if apply or allops[i] is None or journals[i].exists() or \
+                (missing and changes[i] is None):
+            continue
+        snapshot = snapshots[i] or Snapshot(destdirs[i])
+        entries = {}
+        if changes[i] is not None:
+            added, changed, removed = changes[i]
+            entries = dict((src, entry)
+                           for src, entry in snapshot.entries.items()
+                           if src not in changed and src not in removed)
+        # The copies left out by a budget are done by the next run.
+        ops = [op for op in allops[i] if op.get('id') not in skipped[i]]
+        save_snapshot(snapshot, settings[i], entries, ops, sizes, mtimes,
+                      lcatalog, dcatalogs[i])
+    return status
+
 
+def snapshot_settings(pattern, localdirs, fs_rules, transcode, tolerance):
+    """Settings mapping the playlist entries to destination paths: a
+    snapshot taken with other settings is not used."""
+    return {'pattern': pattern, 'localdirs': list(localdirs),
+            'fs_rules': fs_rules, 'transcode': list(transcode or []),
+            'tolerance': tolerance}
+
+
+def save_snapshot(snapshot, settings, entries, ops, sizes, mtimes, lcatalog,
+                  dcatalog):
+    """Update the entries and the destination catalog with the executed
+    operations, and save them as the snapshot."""
+    for op in ops:
+        if op['op'] == 'remove':
+            if op['dst'] in dcatalog:
+                dcatalog.remove(op['dst'])
+            continue
+        src = op['src']
+        if op['op'] == 'skip':
+            # Kept as the existing copy of the track.
+            entries[src] = (sizes[src], mtimes[src],
+                            sorted(c['dst'] for c in op['conflicts'])[0])
+            continue
+        entries[src] = (sizes[src], mtimes[src], op['dst'])
+        if op['dst'] in dcatalog:
+            dcatalog.remove(op['dst'])
+        track = lcatalog[src]
+        dcatalog.add(op['dst'], track.record(), track.tagged)
+    snapshot.save(settings, entries, dcatalog)
+
+
+def execute_operations(destinations, copy_jobs=4, max_inflight=256 * 1024**2,
+                       copy_backend='auto', bufsize=8 * 1024**2,
+                       preallocate=True, fsync_batch=0, transcode_jobs=0,
+                       budgets=None, metrics=None, verify=False,
+                       verify_jobs=4, skipped=None):
+    """Apply the operations of each (journal, operations) destination,
+    recording their progress in its journal, which is removed if they all
+    succeed.
+
+    The removals are done first. Then each source file is read once and
+    written to all the destinations that need it (transcoded tracks are
+    encoded for each). A full destination, or one whose budget (bytes
+    written) is reached, does not stop the copies to the others. A budget
+    completes the run of its destination: the ids of the copies left out
+    are added to the `skipped` set of the destination, if given.
+    Directories emptied by the removals are pruned. The progress of the
+    copies is drawn on a terminal, and their timings are recorded in
+    metrics.
+
+    With verify, the copies are read back from the devices and compared to
+    their sources (see verify.py, transcoded tracks are not checked). The
+    ones that differ are copied again once; if they still differ they are
+    removed, and left for --resume."""
+    metrics = metrics or Metrics()
+    budgets = budgets or [None] * len(destinations)
+    journals = [journal for journal, _ in destinations]
+    print("Copying files...", file=sys.stderr)
+    filecopier = FileCopier(copy_backend, bufsize, preallocate, fsync_batch)
+    workers = copy_jobs
+    transcoder = None
+    if any('transcode' in op for _, ops in destinations for op in ops):
+        # Encoders run in their own processes, next to the copies.
+        transcoder = Transcoder(filecopier, transcode_jobs or None)
+        workers += transcoder.jobs
+
+    removals = []
+    tasks = {}
+    order = []
+    planned = {}
+    transcoded = set()
+    for i, (_, ops) in enumerate(destinations):
+        for op in ops:
+            if op['op'] == 'remove':
+                removals.append((i, op))
+            elif op['op'] == 'copy':
+                key = (op['src'], op['dst']) if 'transcode' in op else op['src']
+                if key not in tasks:
+                    tasks[key] = []
+                    order.append(key)
+                tasks[key].append((i, op))
+                planned[i, op['dst']] = op.get('bytes', op['size'])
+                if 'transcode' in op:
+                    transcoded.add(op['dst'])
+    progress = Progress(sum(planned.values()), len(planned))
+
+    def copied(i, dst):
+        journals[i].copied(dst)
+        progress.update(planned[i, dst])
+
+    fanout = FanoutCopier(transcoder or filecopier, bufsize, preallocate,
+                          start=lambda i, dst: journals[i].started(dst),
+                          done=copied)
+    copier = CopyScheduler(workers, max_inflight,
+                           copy=metrics.timed(fanout, 'copy io'))
+    dirs = [PathPlanner(journal.destdir) for journal in journals]
+    removed_dirs = [set() for _ in destinations]
+    used = [0] * len(destinations)
+    budget_reached = set()
+    with metrics.phase('execute') as phase:
+        try:
+            for i, op in removals:
+                start = time.time()
+                try:
+                    os.remove(op['dst'])
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                metrics.count('remove', time.time() - start)
+                journals[i].done(op['id'])
+                removed_dirs[i].add(os.path.dirname(op['dst']))
+            for key in order:
+                targets = []
+                for i, op in tasks[key]:
+                    if i in fanout.full:
+                        continue
+                    used[i] += planned[i, op['dst']]
+                    if budgets[i] is not None and used[i] > budgets[i]:
+                        print("Budget of %s reached." % journals[i].destdir,
+                              file=sys.stderr)
+                        budget_reached.add(i)
+                        fanout.stop(i)
+                        continue
+                    dirs[i].makedirs(os.path.dirname(op['dst']))
+                    if 'transcode' in op:
+                        transcoder.register(op['dst'],
+                                            op['transcode']['format'],
+                                            op['transcode']['quality'],
+                                            op['transcode']['tags'])
+                    journals[i].register(op)
+                    targets.append((i, op['dst']))
+                if len(fanout.full) == len(destinations):
+                    break
+                if targets and not copier.submit(tasks[key][0][1]['src'],
+                                                 targets,
+                                                 tasks[key][0][1]['size']):
+                    break
+            copier.wait()
+        finally:
+            progress.finish()
+            phase['files'], phase['bytes'] = progress.files, progress.bytes
+
+    verified = {}
+    if verify:
+        copies = dict((i, [(f, destf) for f, destf in copied
+                           if destf not in transcoded])
+                      for i, copied in fanout.copied.items())
+        verified = verify_copies(copies, filecopier, verify_jobs, metrics)
+
+    status = None
+    for i, journal in enumerate(journals):
+        if len(journals) > 1:
+            print("%s:" % journal.destdir, file=sys.stderr)
+        if removed_dirs[i]:
+            pruned = prune_empty_dirs(removed_dirs[i], journal.destdir)
+            if pruned:
+                print("Removed %d empty directories." % pruned, file=sys.stderr)
+        failed = fanout.failed.get(i, [])
+        report_copies(fanout.copied.get(i, []), failed,
+                      "Budget reached" if i in budget_reached else
+                      "Destination full" if i in fanout.full else None)
+        recopied, corrupt = verified.get(i, ([], []))
+        if verify:
+            report_verification(recopied, corrupt)
+        if i in budget_reached and not failed and not corrupt:
+            copies = set(dst for _, dst in fanout.copied.get(i, []))
+            left = set(op['id'] for op in destinations[i][1]
+                       if op['op'] == 'copy' and op['dst'] not in copies)
+            if skipped is not None:
+                skipped[i].update(left)
+            journal.finish()
+        elif i in fanout.full or failed or corrupt:
+            journal.close()
+            print("Run again with --resume to finish the copies.",
+                  file=sys.stderr)
+            status = 1
         else:
-            # TODO: Make a function for this
-            try:
-                os.makedirs(os.path.split(destf)[0])
-            except OSError as e:
-                #if e.errno != errno.EEXIST:
-                    #print >>sys.stderr, e # Beware errno.EINVAL
-                    # TODO: try to use original path
-                    #raise
-                if e.errno == errno.EINVAL:
-                    print >>sys.stderr, "Adapting file name: %s" % destf
-                    destf = destf.replace(':', '-').replace('?', '-')
-                    # recursively call the function
-                    try:
-                        os.makedirs(os.path.split(destf)[0])
-                    except OSError as e:
-                        if e.errno != errno.EEXIST:
-                            print >>sys.stderr, e # Beware errno.EINVAL
+            journal.finish()
+    return status
+
+
+def verify_copies(copies, copy, jobs=4, metrics=None):
+    """Verify the {destination: [(src, dst)]} copies, copy the failed ones
+    again with `copy` and verify them again. Those still failing are
+    removed. Return {destination: (recopied, corrupt)}, lists of (src, dst,
+    reason)."""
+    from verify import HashCache, Verifier
+    metrics = metrics or Metrics()
+    devices = dict((dst, i) for i, pairs in copies.items() for _, dst in pairs)
+    pairs = [pair for i in sorted(copies) for pair in copies[i]]
+    cache = HashCache()
+    verifier = Verifier(cache, jobs)
+    print("Verifying %d copies..." % len(pairs), file=sys.stderr)
+    with metrics.phase('verify') as phase:
+        failed = verifier(pairs)
+        retried = []
+        corrupt = []
+        for f, destf, reason in failed:
             try:
-                # Can choose copyfile, copy or copy2 depending on permissions/metadata
-                shutil.copy2(f, destf)
-            except IOError as e:
-                if e.errno == errno.ENOSPC:
-                    # "No space left on device"
-                    print >>sys.stderr, "Could not copy %s (%s)" % \
-                            (f, e.strerror)
-                    print >>sys.stderr, destf
-                    os.remove(destf)
-                    return
-                else:
-                    raise
+                copy(f, destf)
+            except EnvironmentError as e:
+                corrupt.append((f, destf, e.strerror or str(e)))
+            else:
+                retried.append((f, destf))
+        if retried:
+            corrupt.extend(verifier(retried))
+        for f, destf, _ in corrupt:
+            remove_partial(destf)
+        phase['files'] = len(pairs) + len(retried)
+    cache.close()
+    print(cache.stats(), file=sys.stderr)
+    verified = dict((i, ([], [])) for i in copies)
+    for f, destf, reason in failed:
+        verified[devices[destf]][0].append((f, destf, reason))
+    for f, destf, reason in corrupt:
+        verified[devices[destf]][1].append((f, destf, reason))
+    return verified
+
+
+def report_verification(recopied, corrupt):
+    for f, destf, reason in recopied:
+        print("Copied again (%s): %s" % (reason, destf), file=sys.stderr)
+    for f, destf, reason in corrupt:
+        print("Still corrupt after copying again (%s), removed: %s" %
+              (reason, destf), file=sys.stderr)
+    print("%d files copied again after verification, %d still corrupt." %
+          (len(recopied), len(corrupt)), file=sys.stderr)
+
+
+def report_copies(copied, failed, stopped=None):
+    """Report the copies to a destination. `stopped` is the reason the
+    copies were stopped early, if they were."""
+    for f, destf, e in failed:
+        print("Could not copy %s (%s)" % (f, e.strerror), file=sys.stderr)
+        print(destf, file=sys.stderr)
+    if stopped:
+        print("%s. %d files were copied:" % (stopped, len(copied)),
+              file=sys.stderr)
+        for f, destf in sorted(copied):
+            print(destf, file=sys.stderr)
+    else:
+        print("%d files copied." % len(copied), file=sys.stderr)
 
 # TODO: When errno 22 occurs, check if device has been disconnected.
-# TODO: Parallelize
 
-if __name__=='__main__':
-    parser = argparse.ArgumentParser(description=__doc__)
+def add_arguments(parser):
     parser.add_argument("playlistfile", help=".m3u file")
-    parser.add_argument("destdir", help="root of the music directory (destination)")
-    parser.add_argument("-p", "--pattern", default="%a/%b/%n-%t",
-                        help="structure of the destination folders")
+    parser.add_argument("destdir", nargs='+',
+                        help="root of the music directory (destination). "
+                             "Several destinations are synced in one pass, "
+                             "reading each source file once")
+    parser.add_argument("-p", "--pattern", action='append',
+                        help="structure of the destination folders, once or "
+                             "once per destination [%%a/%%b/%%n-%%t]")
+    parser.add_argument("-B", "--budget", action='append',
+                        type=humannumber2int,
+                        help="maximum size written to the destination, e.g. "
+                             "4GiB, once or once per destination [free space]")
     parser.add_argument("-l", "--localdirs", action='append',
                         default=[], #["~/Music/"],
                         help="roots of the local music directory")
     parser.add_argument("-I", "--ignore-all", action='store_true',
                         help="pass already existing files")
-    #sync(playlistfile, destdir, pattern="%a/%b/%n-%t", localdirs=["~/Musique/"]):
-    args = parser.parse_args()
-    sync(**vars(args))
+    parser.add_argument("-P", "--policy", action='append', metavar='RULE',
+                        help="rule resolving conflicts with existing tracks, "
+                             "tried in the given order, e.g. -P length:2 "
+                             "-P bitrate -P ignore. Rules: bitrate[:KBPS], "
+                             "length:SECONDS, prefer:EXT, replace, ignore, "
+                             "alongside, ask (default)")
+    parser.add_argument("--report", metavar='FILE',
+                        help="write every conflict decision to FILE")
+    parser.add_argument("-M", "--mirror", action='store_true',
+                        help="delete the tracks of destdir that are not in "
+                             "the playlist (before copying), and the emptied "
+                             "directories")
+    parser.add_argument("--fs-rules", default='auto',
+                        choices=['auto', 'posix', 'fat'],
+                        help="naming rules of the destination filesystem "
+                             "(auto: 'fat' on FAT, exFAT and NTFS) "
+                             "[%(default)s]")
+    parser.add_argument("-T", "--transcode", action='append', metavar='RULE',
+                        help="encode the tracks of an extension with ffmpeg, "
+                             "as SRC:FORMAT[:QUALITY], e.g. -T flac:ogg:5 "
+                             "(formats: ogg, mp3, opus)")
+    parser.add_argument("--transcode-jobs", type=int, default=0,
+                        help="number of encoders running concurrently "
+                             "(0: one per CPU) [%(default)s]")
+    parser.add_argument("--metrics", dest='metrics_file', metavar='FILE',
+                        help="save the timings of the run to FILE (JSON)")
+    parser.add_argument("-V", "--verify", action='store_true',
+                        help="read the copies back from the device, compare "
+                             "them to the sources, and copy them again if "
+                             "they differ")
+    parser.add_argument("--verify-jobs", type=int, default=4,
+                        help="number of files hashed concurrently when "
+                             "verifying [%(default)s]")
+    parser.add_argument("-R", "--resume", action='store_true',
+                        help="finish an interrupted sync, from the journal "
+                             "kept in destdir, without rescanning")
+    parser.add_argument("--full-scan", action='store_true',
+                        help="scan the whole playlist and destination, "
+                             "ignoring the snapshot of the last sync (needed "
+                             "after tracks of destdir were modified in place, "
+                             "e.g. retagged)")
+    parser.add_argument("--no-cache", dest='cache', action='store_false',
+                        help="do not use the tag cache (see tagcache.py)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes reading tags [%(default)s]")
+    parser.add_argument("-J", "--copy-jobs", type=int, default=4,
+                        help="number of files copied concurrently [%(default)s]")
+    parser.add_argument("--max-inflight", type=humannumber2int,
+                        default=256 * 1024**2,
+                        help="maximum cumulated size of the files being "
+                             "copied, e.g. 512MiB [256MiB]")
+    parser.add_argument("--copy-backend", default='auto',
+                        choices=['auto'] + available_backends(),
+                        help="system calls used to copy the data [%(default)s]")
+    parser.add_argument("--bufsize", type=humannumber2int, default=8 * 1024**2,
+                        help="bytes copied per system call [8MiB]")
+    parser.add_argument("--no-preallocate", dest='preallocate',
+                        action='store_false',
+                        help="do not reserve the file size before copying")
+    parser.add_argument("--fsync-batch", type=int, default=0, metavar='N',
+                        help="flush the copied files to the device every N "
+                             "files (0: never) [%(default)s]")
+    parser.add_argument("--stat-threads", type=int, default=0,
+                        help="playlist directories read concurrently, for "
+                             "network mounts [%(default)s]")
+    parser.add_argument("-d", "--duration-tolerance", dest='tolerance',
+                        type=float, metavar='SECONDS',
+                        help="only consider tracks with the same tags as "
+                             "duplicates if their durations match")
+    parser.add_argument("--plan-only", metavar='FILE',
+                        help="only scan and resolve the conflicts, and save "
+                             "the plan of the sync to FILE")
+    parser.add_argument("-A", "--apply", action='store_true',
+                        help="playlistfile is a plan saved with --plan-only: "
+                             "execute it without scanning")
+    parser.add_argument("--sort-destination", action='store_true',
+                        help="do the removals first, then the copies grouped "
+                             "by destination directory")
+
+
+def run(args, parser):
+    """Check the parsed arguments and sync. Return the exit status."""
+    args.pattern = args.pattern or "%a/%b/%n-%t"
+    try:
+        Policy(args.policy or [])
+        parse_rules(args.transcode or [])
+        if args.transcode and not args.plan_only:
+            check_encoder()
+        per_destination(args.pattern, len(args.destdir), 'patterns')
+        per_destination(args.budget, len(args.destdir), 'budgets')
+    except ValueError as e:
+        parser.error(str(e))
+    if len(args.destdir) > 1 and (args.plan_only or args.apply):
+        parser.error("--plan-only and --apply take a single destination")
+    return sync(**vars(args))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args(), parser))
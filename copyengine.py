@@ -0,0 +1,448 @@
+"""
+Concurrent file copies for coolsync.
+
+Reads from the source and writes to the device overlap by running several
+copies in a thread pool. The number of copies in flight and their cumulated
+size are bounded, and the first error stops the scheduling of new copies.
+A FanoutCopier writes each source to several devices, and stops the copies
+to a device when it gets full.
+
+The data itself is copied by a FileCopier, which can use the zero-copy
+system calls of the platform or a large userspace buffer, preallocates the
+destination and batches the calls to fsync.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import errno
+import shutil
+import threading
+
+
+class CopyScheduler(object):
+    """Copy files in `workers` threads, with at most `max_inflight` bytes
+    being copied at the same time (a single larger file is still allowed).
+
+    After a copy fails, `submit` refuses new copies; `wait` returns the
+    (src, dst) pairs that were copied and the (src, dst, error) triples that
+    failed, and raises the first error.
+    """
+
+    def __init__(self, workers=4, max_inflight=256 * 1024**2, copy=shutil.copy2):
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.copy = copy
+        self.executor = ThreadPoolExecutor(workers)
+        self.cond = threading.Condition()
+        self.inflight_bytes = 0
+        self.inflight_files = 0
+        self.error = None
+        self.copied = []
+        self.failed = []
+
+    def submit(self, src, dst, size=None):
+        """Schedule the copy of src to dst, blocking while too many bytes are
+        in flight. Return False if no more copies are accepted."""
+        if size is None:
+            size = os.path.getsize(src)
+        with self.cond:
+            while not self.stopped and self.inflight_files and \
+                    (self.inflight_files >= self.workers or
+                     self.inflight_bytes + size > self.max_inflight):
+                self.cond.wait()
+            if self.stopped:
+                return False
+            self.inflight_bytes += size
+            self.inflight_files += 1
+        self.executor.submit(self._copy, src, dst, size)
+        return True
+
+    @property
+    def stopped(self):
+        return self.error is not None
+
+    def _copy(self, src, dst, size):
+        try:
+            self.copy(src, dst)
+        except BaseException as e:
+            with self.cond:
+                self.error = self.error or e
+                self.failed.append((src, dst, e))
+        else:
+            with self.cond:
+                self.copied.append((src, dst))
+        finally:
+            with self.cond:
+                self.inflight_bytes -= size
+                self.inflight_files -= 1
+                self.cond.notify_all()
+
+    def wait(self):
+        """Wait for the copies in flight, and raise the first error."""
+        self.executor.shutdown(wait=True)
+        if hasattr(self.copy, 'flush'):
+            self.copy.flush()
+        if self.error is not None:
+            raise self.error
+        return self.copied, self.failed
+
+
+def copy_file_range(fsrc, fdst, size, bufsize):
+    """Copy inside the kernel, possibly using reflinks or server-side copy."""
+    while True:
+        n = os.copy_file_range(fsrc, fdst, bufsize)
+        if not n:
+            break
+
+
+def copy_sendfile(fsrc, fdst, size, bufsize):
+    offset = 0
+    while True:
+        n = os.sendfile(fdst, fsrc, offset, bufsize)
+        if not n:
+            break
+        offset += n
+
+
+def copy_buffered(fsrc, fdst, size, bufsize):
+    buf = bytearray(min(bufsize, max(size, 1)))
+    view = memoryview(buf)
+    with os.fdopen(os.dup(fsrc), 'rb', 0) as F:
+        while True:
+            n = F.readinto(buf)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write(fdst, view[written:n])
+
+
+# In order of preference for the 'auto' backend.
+BACKENDS = [('copy_file_range', copy_file_range),
+            ('sendfile', copy_sendfile),
+            ('buffered', copy_buffered)]
+
+# errnos meaning that a system call cannot copy between these two files.
+UNSUPPORTED = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                   getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+                   getattr(errno, 'ENOTSUP', errno.EINVAL)])
+
+
+# Linux fallocate(2) flag: reserve the blocks without changing the file size.
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = []
+
+
+def libc_fallocate():
+    """fallocate(2) of the C library (Linux only), or None."""
+    if not _fallocate:
+        func = None
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                libc = ctypes.CDLL(None, use_errno=True)
+                func = getattr(libc, 'fallocate64', None) or libc.fallocate
+                func.argtypes = [ctypes.c_int, ctypes.c_int,
+                                 ctypes.c_int64, ctypes.c_int64]
+            except (ImportError, OSError, AttributeError):
+                func = None
+        _fallocate.append(func)
+    return _fallocate[0]
+
+
+def available_preallocations():
+    """'keep-size': fallocate(FALLOC_FL_KEEP_SIZE), which reserves the
+    blocks without writing anything, or fails on filesystems without
+    support (exFAT). 'posix': posix_fallocate, which the kernel turns into
+    an expanding truncate that zero-fills the file on FAT, and which glibc
+    emulates by writing every block when the filesystem lacks fallocate:
+    the files are then written twice."""
+    modes = []
+    if libc_fallocate() is not None:
+        modes.append('keep-size')
+    if hasattr(os, 'posix_fallocate'):
+        modes.append('posix')
+    return modes
+
+
+def preallocation_mode(preallocate):
+    """Mode used for the `preallocate` option of the copiers: None when
+    False or unavailable, the first available mode when True."""
+    modes = available_preallocations()
+    if preallocate is True:
+        return modes[0] if modes else None
+    if preallocate and preallocate not in modes:
+        raise ValueError("Preallocation not available: %r" % preallocate)
+    return preallocate or None
+
+
+def preallocate_file(fd, size, mode):
+    """Reserve `size` bytes for fd, if the filesystem supports it."""
+    try:
+        if mode == 'keep-size':
+            import ctypes
+            if libc_fallocate()(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+        else:
+            os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+
+
+def available_backends():
+    names = []
+    for name, _ in BACKENDS:
+        if name == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+            continue
+        if name == 'sendfile' and not hasattr(os, 'sendfile'):
+            continue
+        names.append(name)
+    return names + ['shutil']
+
+
+class FileCopier(object):
+    """Callable copying src to dst with the data, permission bits and times
+    (as shutil.copy2).
+
+    backend: 'auto' (first available of copy_file_range, sendfile and
+             buffered), one of these names, or 'shutil' (shutil.copy2).
+             When a system call does not support the two files, the next
+             one is used (ultimately the buffered copy), and counted in
+             `fallbacks`.
+    bufsize: bytes per system call / size of the userspace buffer.
+    preallocate: reserve the whole file size on the destination first, which
+                 avoids fragmentation and fails early when the device is full.
+                 True for the best available mode, or one of
+                 available_preallocations().
+    fsync_batch: flush the copied files to the device every fsync_batch files
+                 (and when flush() is called). 0 leaves it to the OS.
+    """
+
+    def __init__(self, backend='auto', bufsize=8 * 1024**2, preallocate=True,
+                 fsync_batch=0):
+        if backend == 'auto':
+            self.backends = [(name, func) for name, func in BACKENDS
+                             if name in available_backends()]
+        elif backend == 'shutil':
+            self.backends = []
+        else:
+            if backend not in available_backends():
+                raise ValueError("Copy backend not available: %r" % backend)
+            self.backends = [(name, func) for name, func in BACKENDS
+                             if name in (backend, 'buffered')]
+        self.bufsize = bufsize
+        self.preallocate = preallocation_mode(preallocate)
+        self.fsync_batch = fsync_batch
+        self.lock = threading.Lock()
+        self.unsynced = []
+        self.fallbacks = 0
+        self.unsupported = set()
+
+    def __call__(self, src, dst):
+        if not self.backends:
+            shutil.copy2(src, dst)
+        else:
+            fsrc = os.open(src, os.O_RDONLY)
+            try:
+                size = os.fstat(fsrc).st_size
+                fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                try:
+                    self.copydata(fsrc, fdst, size)
+                finally:
+                    os.close(fdst)
+            finally:
+                os.close(fsrc)
+            shutil.copystat(src, dst)
+        if self.fsync_batch:
+            with self.lock:
+                self.unsynced.append(dst)
+                if len(self.unsynced) < self.fsync_batch:
+                    return
+                batch, self.unsynced = self.unsynced, []
+            fsync_paths(batch)
+
+    def copydata(self, fsrc, fdst, size):
+        if self.preallocate and size:
+            preallocate_file(fdst, size, self.preallocate)
+        devices = (os.fstat(fsrc).st_dev, os.fstat(fdst).st_dev)
+        backends = [(name, func) for name, func in self.backends
+                    if (name,) + devices not in self.unsupported]
+        for i, (name, func) in enumerate(backends):
+            try:
+                func(fsrc, fdst, size, self.bufsize)
+                break
+            except OSError as e:
+                # Only fall back if nothing was copied yet.
+                if e.errno not in UNSUPPORTED or \
+                        i == len(backends) - 1 or \
+                        os.lseek(fdst, 0, os.SEEK_CUR) > 0:
+                    raise
+                os.lseek(fsrc, 0, os.SEEK_SET)
+                with self.lock:
+                    # Do not try it again between these two filesystems.
+                    self.unsupported.add((name,) + devices)
+                    self.fallbacks += 1
+        # The source might have shrunk since it was preallocated.
+        copied = os.lseek(fdst, 0, os.SEEK_CUR)
+        if self.preallocate and copied < size:
+            os.ftruncate(fdst, copied)
+
+    def flush(self):
+        with self.lock:
+            batch, self.unsynced = self.unsynced, []
+        fsync_paths(batch)
+
+
+class FanoutCopier(object):
+    """Callable copying src to several destinations, given as a list of
+    (device, dst) targets, reading src once.
+
+    A device getting full (ENOSPC) only stops the copies to this device: the
+    partial file is removed, the device is added to `full`, and its targets
+    are skipped from then on. Other errors are raised. The copied and failed
+    targets are listed per device in `copied` and `failed`.
+
+    A single target is copied by `copy` (e.g. a FileCopier). The optional
+    `start` and `done` callbacks get (device, dst) around each copy.
+    """
+
+    def __init__(self, copy, bufsize=8 * 1024**2, preallocate=True,
+                 start=None, done=None):
+        self.copy = copy
+        self.bufsize = bufsize
+        self.preallocate = preallocation_mode(preallocate)
+        self.start = start or (lambda device, dst: None)
+        self.done = done or (lambda device, dst: None)
+        self.lock = threading.Lock()
+        self.full = set()
+        self.copied = {}
+        self.failed = {}
+        if hasattr(copy, 'flush'):
+            self.flush = copy.flush
+
+    def active(self, targets):
+        with self.lock:
+            return [(device, dst) for device, dst in targets
+                    if device not in self.full]
+
+    def stop(self, device):
+        """Skip the later copies to device."""
+        with self.lock:
+            self.full.add(device)
+
+    def record(self, device, src, dst, error=None):
+        with self.lock:
+            if error is None:
+                self.copied.setdefault(device, []).append((src, dst))
+            else:
+                self.failed.setdefault(device, []).append((src, dst, error))
+                if error.errno == errno.ENOSPC:
+                    self.full.add(device)
+
+    def __call__(self, src, targets):
+        targets = self.active(targets)
+        for device, dst in targets:
+            self.start(device, dst)
+        if len(targets) == 1:
+            device, dst = targets[0]
+            try:
+                self.copy(src, dst)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                remove_partial(dst)
+                self.record(device, src, dst, e)
+                return
+        elif targets:
+            targets = self.copy_fanout(src, targets)
+        for device, dst in targets:
+            self.record(device, src, dst)
+            self.done(device, dst)
+
+    def copy_fanout(self, src, targets):
+        """Stream src to all targets. Return those that succeeded."""
+        fds = []
+        try:
+            with open(src, 'rb', 0) as F:
+                size = os.fstat(F.fileno()).st_size
+                for device, dst in targets:
+                    fds.append((device, dst,
+                                os.open(dst, os.O_WRONLY | os.O_CREAT |
+                                        os.O_TRUNC, 0o666)))
+                fds = self.write_all(fds, lambda fd: self.allocate(fd, size),
+                                     src)
+                buf = bytearray(min(self.bufsize, max(size, 1)))
+                view = memoryview(buf)
+                while fds:
+                    n = F.readinto(buf)
+                    if not n:
+                        break
+                    fds = self.write_all(fds, lambda fd: write_fully(fd, view[:n]),
+                                         src)
+                fds = self.write_all(fds, lambda fd: os.ftruncate(
+                    fd, os.lseek(fd, 0, os.SEEK_CUR)), src)
+        finally:
+            for _, _, fd in fds:
+                os.close(fd)
+        for _, dst, _ in fds:
+            shutil.copystat(src, dst)
+        return [(device, dst) for device, dst, _ in fds]
+
+    def allocate(self, fd, size):
+        if self.preallocate and size:
+            preallocate_file(fd, size, self.preallocate)
+
+    def write_all(self, fds, func, src):
+        """Apply func to each fd. Drop those whose device got full."""
+        kept = []
+        for device, dst, fd in fds:
+            try:
+                func(fd)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                os.close(fd)
+                remove_partial(dst)
+                self.record(device, src, dst, e)
+            else:
+                kept.append((device, dst, fd))
+        return kept
+
+
+def write_fully(fd, data):
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def fsync_paths(paths):
+    """fsync files, then their directories (once each)."""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for dirname in sorted(set(os.path.dirname(path) for path in paths)):
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            # Some filesystems do not support syncing directories.
+            if e.errno not in UNSUPPORTED:
+                raise
+        finally:
+            os.close(fd)
+
+
+def remove_partial(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,137 @@
+"""
+Destination paths of coolsync, valid on the destination filesystem.
+
+The naming rules of the filesystem are applied when planning, instead of
+retrying after errors when copying: on FAT/exFAT/NTFS devices, reserved
+characters are replaced, trailing dots and spaces are removed, reserved
+device names are suffixed, and names are compared case-insensitively.
+Every filesystem limits the length of names (255).
+
+Planned paths that collide (the same name on the device for two different
+sources) are detected before copying, and renamed. The directories are
+created once each.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import re
+import errno
+
+
+# Filesystem types (as in /proc/mounts) with the Windows naming rules.
+FAT_TYPES = set(['vfat', 'msdos', 'fat', 'exfat', 'ntfs', 'ntfs3', 'fuseblk'])
+
+FAT_RESERVED = re.compile(r'[\x00-\x1f<>:"\\|?*]')
+FAT_DEVICES = set(['CON', 'PRN', 'AUX', 'NUL'] +
+                  ['COM%d' % i for i in range(1, 10)] +
+                  ['LPT%d' % i for i in range(1, 10)])
+NAME_MAX = 255
+
+
+def filesystem_type(path, mounts='/proc/mounts'):
+    """Type of the filesystem containing path (Linux), or None."""
+    path = op.realpath(path)
+    best, fstype = '', None
+    try:
+        with open(mounts) as F:
+            for line in F:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces in mount points are escaped as \040.
+                mountpoint = fields[1].replace('\\040', ' ')
+                if (path == mountpoint or
+                        path.startswith(mountpoint.rstrip('/') + '/')) and \
+                        len(mountpoint) >= len(best):
+                    best, fstype = mountpoint, fields[2]
+    except (IOError, OSError):
+        return None
+    return fstype
+
+
+def detect_rules(destdir):
+    if os.name == 'nt':
+        return 'fat'
+    return 'fat' if filesystem_type(destdir) in FAT_TYPES else 'posix'
+
+
+def truncate_name(name, encoded):
+    """Shorten a file name to NAME_MAX (bytes if encoded), keeping its
+    extension."""
+    def length(s):
+        return len(s.encode('utf-8')) if encoded else len(s)
+    if length(name) <= NAME_MAX:
+        return name
+    stem, ext = op.splitext(name)
+    while stem and length(stem + ext) > NAME_MAX:
+        stem = stem[:-1]
+    return stem + ext
+
+
+class PathPlanner(object):
+    """Sanitize the destination paths according to `rules` ('posix', 'fat'
+    or 'auto' to detect them from the filesystem of destdir), detect their
+    collisions and create their directories."""
+
+    def __init__(self, destdir, rules='auto'):
+        self.destdir = destdir
+        self.rules = detect_rules(destdir) if rules == 'auto' else rules
+        if self.rules not in ('posix', 'fat'):
+            raise ValueError("Unknown naming rules: %r" % rules)
+        self.planned = {}
+        self.collisions = []
+        self.created = set()
+
+    def sanitize_name(self, name):
+        if self.rules == 'fat':
+            name = FAT_RESERVED.sub('-', name).rstrip('. ')
+            stem, ext = op.splitext(name)
+            if stem.upper() in FAT_DEVICES:
+                name = stem + '_' + ext
+            name = name or '_'
+        elif name in ('', '.', '..'):
+            name = '_'
+        return truncate_name(name, encoded=self.rules == 'posix')
+
+    def sanitize(self, path):
+        """The path below destdir, with valid names."""
+        relpath = op.relpath(path, self.destdir)
+        names = [self.sanitize_name(name) for name in relpath.split(os.sep)]
+        return op.join(self.destdir, *names)
+
+    def key(self, path):
+        """Paths with the same key are the same file on the destination."""
+        return path.lower() if self.rules == 'fat' else path
+
+    def plan(self, path, src):
+        """Sanitized path for the copy of src. If another source was already
+        planned there, the collision is recorded and a free name is
+        returned: 'name (2).ext'..."""
+        path = self.sanitize(path)
+        stem, ext = op.splitext(path)
+        i = 1
+        while self.planned.setdefault(self.key(path), src) != src:
+            i += 1
+            path = stem + (' (%d)' % i) + ext
+        if i > 1:
+            self.collisions.append((src, path))
+        return path
+
+    def makedirs(self, dirname):
+        """Create dirname (and parents) unless already created or seen."""
+        if dirname in self.created:
+            return
+        if not op.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                # Created concurrently.
+                if e.errno != errno.EEXIST:
+                    raise
+        while dirname and dirname not in self.created:
+            self.created.add(dirname)
+            if op.dirname(dirname) == dirname:
+                break
+            dirname = op.dirname(dirname)
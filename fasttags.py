@@ -0,0 +1,490 @@
+"""
+Fast reader of the tags used by coolsync, for MP3, FLAC and M4A files.
+
+Only the fields of coolsync records are parsed ('abnty', bitrate and
+length): the needed ID3v2 frames and the first MPEG frame (and its
+Xing/LAME header), the FLAC STREAMINFO and VORBIS_COMMENT blocks, and the
+MP4 mdhd/esds and moov/udta/meta/ilst atoms. Other parts of the files are
+skipped without being read, so a file is read in a few small chunks.
+
+The records are the ones coolsync.read_audiotags gets from mutagen. Any
+file this reader is not sure to read the same way (ID3v1 tags,
+unsynchronised or compressed frames, VBRI headers, other codecs...) raises
+Unsupported, and is left to mutagen.
+"""
+
+from __future__ import print_function
+
+import os
+import struct
+
+
+class Unsupported(Exception):
+    pass
+
+
+def read_tags(path):
+    """Return the (record, tagged) of coolsync.read_audiotags, or raise
+    Unsupported."""
+    reader = READERS.get(os.path.splitext(path)[1])
+    if reader is None:
+        raise Unsupported("unsupported extension: %s" % path)
+    with open(path, 'rb') as F:
+        try:
+            return reader(F)
+        except (struct.error, ValueError, IndexError, KeyError,
+                UnicodeError) as e:
+            raise Unsupported("%s: %s" % (path, e))
+
+
+def file_size(F):
+    return os.fstat(F.fileno()).st_size
+
+
+def read_exactly(F, n):
+    data = F.read(n)
+    if len(data) != n:
+        raise Unsupported("truncated file")
+    return data
+
+
+def syncsafe(data):
+    """28-bit integer stored in 4 bytes of 7 bits (ID3v2 sizes)."""
+    b = bytearray(data)
+    if any(x & 0x80 for x in b):
+        raise Unsupported("invalid synchsafe integer")
+    return b[0] << 21 | b[1] << 14 | b[2] << 7 | b[3]
+
+
+# --- MP3 ---
+
+# mutagen converts TYER (ID3v2.3) to TDRC, which read_audiotags does not
+# look for: MP3 records have no year.
+ID3_FRAMES = {b'TPE1': 'a', b'TALB': 'b', b'TRCK': 'n', b'TIT2': 't'}
+ID3_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+# Frame flags: compression, encryption (and unsynchronisation, data length)
+ID3_UNSUPPORTED_FLAGS = {3: 0x00c0, 4: 0x000f}
+
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+             416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+             384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+             256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_BITRATES[(2, 3)] = MPEG_BITRATES[(2, 2)]
+for layer in (1, 2, 3):
+    MPEG_BITRATES[(2.5, layer)] = MPEG_BITRATES[(2, layer)]
+MPEG_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000],
+              2.5: [11025, 12000, 8000]}
+
+
+def decode_text(data):
+    """First value of an ID3v2 text frame."""
+    encoding = ID3_ENCODINGS[bytearray(data[:1])[0]]
+    text = data[1:].decode(encoding)
+    values = text.rstrip(u'\x00').split(u'\x00')
+    if not values[0] and len(data) <= 1:
+        raise Unsupported("empty text frame")
+    return values[0]
+
+
+def read_id3(F, record):
+    """Read the ID3v2 frames at the start of F into record. Return the
+    offset of the end of the tag, or None if there is none."""
+    header = F.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return None
+    major, _, flags = bytearray(header[3:6])
+    if major not in (3, 4) or flags & 0xc0:
+        # ID3v2.2, unsynchronisation or extended header
+        raise Unsupported("ID3v2.%d tag with flags %#x" % (major, flags))
+    end = 10 + syncsafe(header[6:10])
+    pos = 10
+    while pos + 10 <= end:
+        F.seek(pos)
+        frame = read_exactly(F, 10)
+        frameid = frame[:4]
+        if frameid[:1] == b'\x00':
+            break  # padding
+        if not frameid.isalnum() or frameid.upper() != frameid:
+            raise Unsupported("invalid frame %r" % frameid)
+        size = syncsafe(frame[4:8]) if major == 4 else \
+               struct.unpack('>I', frame[4:8])[0]
+        key = ID3_FRAMES.get(frameid)
+        if key is not None and key not in record:
+            if struct.unpack('>H', frame[8:10])[0] & \
+                    ID3_UNSUPPORTED_FLAGS[major]:
+                raise Unsupported("encoded frame %r" % frameid)
+            record[key] = decode_text(read_exactly(F, size))
+        pos += 10 + size
+    if pos > end:
+        raise Unsupported("frames overflow the tag")
+    return end + (10 if flags & 0x10 else 0)  # footer
+
+
+def skip_id3(F, offset):
+    """Skip the ID3v2 tags stacked at offset, as mutagen does."""
+    while True:
+        F.seek(offset)
+        header = F.read(10)
+        if len(header) < 10 or header[:3] != b'ID3':
+            return offset
+        size = syncsafe(header[6:10])
+        if not size:
+            return offset
+        offset += 10 + size
+
+
+def mpeg_frame(F, offset):
+    """Header fields of the MPEG frame at offset, or None."""
+    F.seek(offset)
+    data = F.read(4)
+    if len(data) < 4:
+        return None
+    h = struct.unpack('>I', data)[0]
+    if h >> 21 != 0x7ff:
+        return None
+    version, layer = h >> 19 & 3, h >> 17 & 3
+    bitrate, rate, padding = h >> 12 & 0xf, h >> 10 & 3, h >> 9 & 1
+    if version == 1 or layer == 0 or rate == 3 or bitrate in (0, 0xf):
+        return None
+    version = [2.5, None, 2, 1][version]
+    layer = 4 - layer
+    frame = {'offset': offset, 'version': version, 'layer': layer,
+             'mode': h >> 6 & 3,
+             'bitrate': MPEG_BITRATES[(version, layer)][bitrate] * 1000,
+             'sample_rate': MPEG_RATES[version][rate]}
+    if layer == 1:
+        frame['samples'], slot = 384, 4
+    elif version >= 2 and layer == 3:
+        frame['samples'], slot = 576, 1
+    else:
+        frame['samples'], slot = 1152, 1
+    frame['length'] = (frame['samples'] // 8 * frame['bitrate'] //
+                       frame['sample_rate'] + padding) * slot
+    return frame
+
+
+def lame_delays(data):
+    """Encoder delay and padding from the data following a Xing header, or
+    (0, 0) if there is no LAME header."""
+    if not data.startswith((b'LAME', b'L3.99')):
+        return 0, 0
+    version = data[:20].lstrip(b'EMAL')
+    major, version = version[:1], version[1:].lstrip(b'.')
+    minor = b''
+    while version[len(minor):len(minor) + 1].isdigit():
+        minor += version[len(minor):len(minor) + 1]
+    rest = version[len(minor):]
+    major, minor = int(major), int(minor)
+    if (major, minor) < (3, 90) or \
+            ((major, minor) == (3, 90) and rest[-11:-10] == b'('):
+        return 0, 0
+    if len(rest) < 11:
+        raise Unsupported("invalid LAME version")
+    header = bytearray(data[9:36])
+    if len(header) != 27 or header[0] >> 4:
+        return 0, 0
+    delays = header[12] << 16 | header[13] << 8 | header[14]
+    return delays >> 12, delays & 0xfff
+
+
+def xing_info(F, frame):
+    """(length, bitrate) from the Xing header of the frame, or None."""
+    if frame['version'] == 1:
+        offset = 36 if frame['mode'] != 3 else 21
+    else:
+        offset = 21 if frame['mode'] != 3 else 13
+    F.seek(frame['offset'] + offset)
+    data = F.read(8 + 4 + 4 + 100 + 4 + 36)
+    if len(data) < 8 or data[:4] not in (b'Xing', b'Info'):
+        return None
+    flags = struct.unpack('>I', data[4:8])[0]
+    pos = 8
+    frames = nbytes = -1
+    if flags & 0x1:
+        frames = struct.unpack('>I', read_field(data, pos, 4))[0]
+        pos += 4
+    if flags & 0x2:
+        nbytes = struct.unpack('>I', read_field(data, pos, 4))[0]
+        pos += 4
+    if flags & 0x4:
+        read_field(data, pos, 100)
+        pos += 100
+    if flags & 0x8:
+        read_field(data, pos, 4)
+        pos += 4
+    bitrate, length = frame['bitrate'], -1
+    if frames != -1:
+        samples = frame['samples'] * frames
+        if nbytes != -1 and samples > 0:
+            audio_bytes = max(0, nbytes - frame['length'])
+            bitrate = int(round(audio_bytes * 8 * frame['sample_rate'] /
+                                float(samples)))
+        delay, padding = lame_delays(data[pos:])
+        samples = max(samples - delay - padding, 0)
+        length = float(samples) / frame['sample_rate']
+    return length, bitrate
+
+
+def read_field(data, pos, n):
+    if len(data) < pos + n:
+        raise Unsupported("truncated Xing header")
+    return data[pos:pos + n]
+
+
+def read_mp3(F):
+    size = file_size(F)
+    if size >= 128:
+        F.seek(-128, 2)
+        if F.read(3) == b'TAG':
+            raise Unsupported("ID3v1 tag")
+    F.seek(0)
+    record = {}
+    end = read_id3(F, record)
+    tagged = end is not None
+    offset = skip_id3(F, end or 0)
+    first = mpeg_frame(F, offset)
+    if first is None:
+        raise Unsupported("no MPEG frame at %d" % offset)
+    info = xing_info(F, first) if first['layer'] == 3 else None
+    if info is None:
+        F.seek(offset + 36)
+        if F.read(4) == b'VBRI':
+            raise Unsupported("VBRI header")
+        # Without a VBR header, mutagen checks 4 consecutive frames.
+        frame = first
+        for _ in range(3):
+            frame = mpeg_frame(F, frame['offset'] + frame['length'])
+            if frame is None:
+                raise Unsupported("no consecutive MPEG frames")
+        info = -1, first['bitrate']
+    length, bitrate = info
+    if length == -1:
+        length = 8 * (size - offset) / float(bitrate)
+    record['bitrate'] = bitrate
+    record['length'] = length
+    return record, tagged
+
+
+# --- FLAC ---
+
+VORBIS_FIELDS = {'artist': 'a', 'album': 'b', 'tracknumber': 'n',
+                 'title': 't', 'date': 'y'}
+
+
+def read_vorbis_comment(data, record):
+    vendor = struct.unpack('<I', data[:4])[0]
+    pos = 4 + vendor
+    count = struct.unpack('<I', data[pos:pos + 4])[0]
+    pos += 4
+    for _ in range(count):
+        length = struct.unpack('<I', data[pos:pos + 4])[0]
+        comment = data[pos + 4:pos + 4 + length]
+        if len(comment) != length or b'=' not in comment:
+            raise Unsupported("invalid comment")
+        pos += 4 + length
+        name, value = comment.split(b'=', 1)
+        key = VORBIS_FIELDS.get(name.decode('ascii').lower())
+        if key is not None and key not in record:
+            record[key] = value.decode('utf-8', 'replace')
+
+
+def read_flac(F):
+    if F.read(4) != b'fLaC':
+        raise Unsupported("not a FLAC stream")
+    record = {}
+    tagged = False
+    length = None
+    last = False
+    while not last:
+        header = read_exactly(F, 4)
+        blocktype = bytearray(header[:1])[0]
+        last, blocktype = blocktype & 0x80, blocktype & 0x7f
+        size = struct.unpack('>I', b'\x00' + header[1:])[0]
+        if blocktype == 0 and length is None:
+            info = struct.unpack('>Q', read_exactly(F, size)[10:18])[0]
+            rate, samples = info >> 44, info & 0xfffffffff
+            if not rate:
+                raise Unsupported("no sample rate")
+            length = samples / float(rate)
+        elif blocktype == 4 and not tagged:
+            read_vorbis_comment(read_exactly(F, size), record)
+            tagged = True
+        elif blocktype in (0, 4, 127):
+            raise Unsupported("block of type %d" % blocktype)
+        else:
+            F.seek(size, 1)
+    if length is None:
+        raise Unsupported("no STREAMINFO block")
+    audio = file_size(F) - F.tell()
+    record['bitrate'] = int(audio * 8 / length) if length else 0
+    record['length'] = length
+    return record, tagged
+
+
+# --- MP4 ---
+
+MP4_TEXT = {b'\xa9ART': 'a', b'\xa9alb': 'b', b'\xa9nam': 't',
+            b'\xa9day': 'y'}
+
+
+def atoms(F, start, end):
+    """Yield the (name, payload start, end) of the atoms between start and
+    end."""
+    pos = start
+    while pos + 8 <= end:
+        F.seek(pos)
+        size, name = struct.unpack('>I4s', read_exactly(F, 8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', read_exactly(F, 8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise Unsupported("invalid atom %r" % name)
+        yield name, pos + header, pos + size
+        pos += size
+
+
+def find_atom(F, start, end, *path):
+    """(payload start, end) of the first atom at path, or None. The payload
+    of 'meta' (a full atom) starts after its version and flags."""
+    for name in path:
+        for child, cstart, cend in atoms(F, start, end):
+            if child == name:
+                start, end = cstart + (4 if name == b'meta' else 0), cend
+                break
+        else:
+            return None
+    return start, end
+
+
+def read_atom(F, span):
+    F.seek(span[0])
+    return read_exactly(F, span[1] - span[0])
+
+
+def descriptor(data, pos):
+    """(tag, payload start, end) of the MPEG-4 descriptor at pos."""
+    tag = bytearray(data[pos:pos + 1])[0]
+    pos += 1
+    size = 0
+    for _ in range(4):
+        b = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        size = size << 7 | b & 0x7f
+        if not b & 0x80:
+            break
+    return tag, pos, pos + size
+
+
+def esds_bitrate(data):
+    """Average bitrate of the DecoderConfigDescriptor of an esds atom."""
+    if data[:1] != b'\x00':
+        raise Unsupported("esds version")
+    tag, pos, _ = descriptor(data, 4)
+    if tag != 3:
+        raise Unsupported("no ES descriptor")
+    flags = bytearray(data[pos + 2:pos + 3])[0]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + bytearray(data[pos:pos + 1])[0]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, _ = descriptor(data, pos)
+    if tag != 4:
+        raise Unsupported("no decoder config descriptor")
+    return struct.unpack('>I', read_field(data, pos + 9, 4))[0]
+
+
+def read_mp4_info(F, moov):
+    """(length, bitrate) of the first sound track."""
+    for name, start, end in atoms(F, *moov):
+        if name != b'trak':
+            continue
+        hdlr = find_atom(F, start, end, b'mdia', b'hdlr')
+        if hdlr is None:
+            raise Unsupported("no hdlr atom")
+        if read_atom(F, hdlr)[8:12] == b'soun':
+            break
+    else:
+        raise Unsupported("no sound track")
+    mdhd = read_atom(F, find_atom(F, start, end, b'mdia', b'mdhd'))
+    version = bytearray(mdhd[:1])[0]
+    if version == 0:
+        unit, duration = struct.unpack('>2I', mdhd[12:20])
+    elif version == 1:
+        unit, duration = struct.unpack('>IQ', mdhd[20:32])
+    else:
+        raise Unsupported("mdhd version %d" % version)
+    length = float(duration) / unit if unit else 0
+    stsd = find_atom(F, start, end, b'mdia', b'minf', b'stbl', b'stsd')
+    if stsd is None:
+        return length, 0
+    data = read_atom(F, stsd)
+    if data[:1] != b'\x00':
+        raise Unsupported("stsd version")
+    if not struct.unpack('>I', data[4:8])[0]:
+        return length, 0
+    size, codec = struct.unpack('>I4s', data[8:16])
+    if codec != b'mp4a':
+        raise Unsupported("codec %r" % codec)
+    entry = data[16:8 + size]
+    # SampleEntry and AudioSampleEntry fields, then the esds atom
+    if len(entry) < 36 or entry[32:36] != b'esds':
+        return length, 0
+    esds_size = struct.unpack('>I', entry[28:32])[0]
+    return length, esds_bitrate(entry[36:28 + esds_size])
+
+
+def read_ilst(F, ilst, record):
+    for name, start, end in atoms(F, *ilst):
+        if name != b'trkn' and name not in MP4_TEXT:
+            continue
+        values = []
+        for child, dstart, dend in atoms(F, start, end):
+            F.seek(dstart)
+            data = read_exactly(F, dend - dstart)
+            if child != b'data' or len(data) < 8:
+                raise Unsupported("unexpected atom %r in %r" % (child, name))
+            flags = struct.unpack('>I', data[:4])[0] & 0xffffff
+            if name == b'trkn':
+                values.append(struct.unpack('>2H', data[10:14]))
+            elif flags in (0, 1):
+                values.append(data[8:].decode('utf-8'))
+            else:
+                raise Unsupported("atom %r of type %d" % (name, flags))
+        if not values:
+            raise Unsupported("empty atom %r" % name)
+        key = 'n' if name == b'trkn' else MP4_TEXT[name]
+        record.setdefault(key, values[0])
+
+
+def read_mp4(F):
+    size = file_size(F)
+    top = list(atoms(F, 0, size))
+    if not top or top[0][0] != b'ftyp':
+        raise Unsupported("not a MP4 file")
+    moov = [(start, end) for name, start, end in top if name == b'moov']
+    if not moov:
+        raise Unsupported("no moov atom")
+    record = {}
+    ilst = find_atom(F, moov[0][0], moov[0][1], b'udta', b'meta', b'ilst')
+    if ilst is not None:
+        read_ilst(F, ilst, record)
+    record['length'], record['bitrate'] = read_mp4_info(F, moov[0])
+    return record, ilst is not None
+
+
+READERS = {'.mp3': read_mp3, '.MP3': read_mp3, '.flac': read_flac,
+           '.m4a': read_mp4}
@@ -0,0 +1,145 @@
+"""
+Write-ahead journal of a coolsync run, kept on the destination.
+
+Before copying, the planned operations are written (and synced to the
+device). Each copy is then marked as started and done, with the size and
+mtime of the copied file. If the run is interrupted, the journal tells which
+files are partial, and which operations remain to be done: `coolsync
+--resume` carries on from there without rescanning.
+
+The journal is a file of JSON lines, removed when the run completes.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import json
+import errno
+import threading
+
+
+JOURNAL_FILENAME = '.coolsync-journal'
+
+
+class Journal(object):
+
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.path = op.join(destdir, JOURNAL_FILENAME)
+        self.lock = threading.Lock()
+        self.F = None
+        self.ids = {}
+
+    def exists(self):
+        return op.exists(self.path)
+
+    def read(self):
+        """Return {id: operation} of the planned operations, the ids of the
+        started ones, and {id: (size, mtime)} of the done ones. A truncated
+        line (from an interruption) is ignored."""
+        ops, started, done = {}, set(), {}
+        with open(self.path) as F:
+            for line in F:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['op'] in ('copy', 'remove'):
+                    ops[entry['id']] = entry
+                elif entry['op'] == 'start':
+                    started.add(entry['id'])
+                elif entry['op'] == 'done':
+                    done[entry['id']] = (entry.get('size'), entry.get('mtime'))
+        return ops, started, done
+
+    def cleanup(self):
+        """Remove the partial files of the copies that were started but not
+        done. Return their paths."""
+        ops, started, done = self.read()
+        partial = []
+        for i in sorted(started - set(done)):
+            dst = ops[i]['dst']
+            try:
+                os.remove(dst)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                partial.append(dst)
+        return partial
+
+    def pending(self):
+        """Operations of the journal still to do. Copies marked as done are
+        checked against the size and mtime of the destination file."""
+        ops, started, done = self.read()
+        todo = []
+        for _, op_ in sorted(ops.items()):
+            if op_['id'] in done:
+                if op_['op'] == 'remove':
+                    continue
+                size, mtime = done[op_['id']]
+                try:
+                    st = os.stat(op_['dst'])
+                except OSError:
+                    pass
+                else:
+                    if (st.st_size, st.st_mtime) == (size, mtime):
+                        continue
+            todo.append(op_)
+        return todo
+
+    def begin(self, ops):
+        """Start a new journal with the planned operations (dicts with an
+        'op' key: 'copy' with 'src', 'dst', 'size', or 'remove' with 'dst',
+        see syncplan).
+        Their 'id' is set to their index."""
+        self.F = open(self.path, 'w')
+        for i, op_ in enumerate(ops):
+            op_['id'] = i
+            self.F.write(json.dumps(op_) + '\n')
+        self.F.flush()
+        os.fsync(self.F.fileno())
+
+    def reopen(self):
+        """Append to the existing journal (when resuming)."""
+        self.F = open(self.path, 'a')
+        # Terminate a line truncated by the interruption.
+        if self.F.tell() > 0:
+            with open(self.path, 'rb') as F:
+                F.seek(-1, os.SEEK_END)
+                if F.read(1) != b'\n':
+                    self.F.write('\n')
+
+    def write(self, entry):
+        with self.lock:
+            self.F.write(json.dumps(entry) + '\n')
+            self.F.flush()
+
+    def register(self, op_):
+        """Record the destination of a copy, before starting it."""
+        self.ids[op_['dst']] = op_['id']
+
+    def done(self, op_id, dst=None):
+        entry = {'op': 'done', 'id': op_id}
+        if dst is not None:
+            st = os.stat(dst)
+            entry['size'], entry['mtime'] = st.st_size, st.st_mtime
+        self.write(entry)
+
+    def started(self, dst):
+        """Mark the copy to dst (recorded with `register`) as started."""
+        self.write({'op': 'start', 'id': self.ids[dst]})
+
+    def copied(self, dst):
+        self.done(self.ids[dst], dst)
+
+    def close(self):
+        if self.F is not None:
+            self.F.close()
+            self.F = None
+
+    def finish(self):
+        """The run completed: remove the journal."""
+        self.close()
+        os.remove(self.path)
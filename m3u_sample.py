@@ -1,26 +1,44 @@
 #!/usr/bin/env python3
 
-"""Randomly select tracks from a m3u playlist, limited to a given storage capacity"""
+"""Randomly select tracks from a m3u playlist, limited to a given storage capacity,
+and optionally to a total duration and a number of tracks per artist/album"""
 
 from __future__ import print_function
 
 from sys import stdin, stdout, stderr
 import argparse
-from playlisttools import iter_playlist, fixedsize_sample, write_paths, humanize_number
+from pathset import PathSet
+from playlisttools import iter_playlist, fixedsize_sample, capacity_sample, \
+                          write_paths, humanize_number
+from tracktable import budget_sample, STRATA
 
 
-def main(infile, outfile, exclude=None, maxsize='8GiB', epsilon='3MiB'):
-    urlset = set(iter_playlist(infile))
+def main(infile, outfile, exclude=None, maxsize='8GiB', epsilon='3MiB',
+         seed=None, random_walk=False, threads=0, maxlength=None,
+         per_artist=None, per_album=None, stratify=None, jobs=1):
+    urlset = PathSet(iter_playlist(infile))
     if exclude:
-        urlset -= set(iter_playlist(exclude))
-    size, sample = fixedsize_sample(urlset, maxsize, epsilon)
+        with open(exclude) as F:
+            urlset -= PathSet(iter_playlist(F))
+    length = None
+    if random_walk:
+        size, sample = fixedsize_sample(urlset, maxsize, epsilon)
+    elif maxlength or stratify or per_artist is not None or \
+            per_album is not None:
+        size, length, sample = budget_sample(urlset, maxsize, epsilon,
+                                             maxlength, per_artist, per_album,
+                                             stratify, seed, threads, jobs)
+    else:
+        size, sample = capacity_sample(urlset, maxsize, epsilon, seed,
+                                       threads)
     print("# Playlist size " + humanize_number(size))
+    if length is not None:
+        print("# Playlist length %d:%02d:%02d" % (length // 3600,
+              length // 60 % 60, length % 60))
     write_paths(sample, outfile)
 
 
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(__doc__)
+def add_arguments(parser):
     parser.add_argument('infile', nargs='?', type=argparse.FileType('r'),
                         default=stdin)
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'),
@@ -31,5 +49,31 @@ if __name__ == '__main__':
                         help='maximum cumulated file size of the playlist [%(default)s]')
     parser.add_argument('-e', '--epsilon', default='300KiB',
                         help='convergence threshold [%(default)s]')
+    parser.add_argument('-S', '--seed', type=int,
+                        help='random seed, to reproduce a sample')
+    parser.add_argument('--random-walk', action='store_true',
+                        help='use the previous algorithm (randomly add and '
+                             'remove batches of files)')
+    parser.add_argument('-t', '--threads', type=int, default=0,
+                        help='directories read concurrently, for network '
+                             'mounts [%(default)s]')
+    parser.add_argument('-d', '--maxlength',
+                        help='maximum total duration (e.g. 90min, 10h, '
+                             '1:30:00)')
+    parser.add_argument('--per-artist', type=int,
+                        help='maximum number of tracks per artist')
+    parser.add_argument('--per-album', type=int,
+                        help='maximum number of tracks per album')
+    parser.add_argument('--stratify', choices=STRATA,
+                        help='pick the tracks round-robin over the artists '
+                             'or albums, instead of uniformly')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes reading the tags '
+                             '[%(default)s]')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(__doc__)
+    add_arguments(parser)
     args = parser.parse_args()
     main(**vars(args))
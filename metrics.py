@@ -0,0 +1,152 @@
+"""
+Instrumentation of coolsync runs.
+
+A Metrics object records the wall time, files and bytes of each phase of a
+sync, and the time spent in some calls (tag parsing, copy I/O), summed
+over the threads or processes doing them. It is printed at the end of the
+run and can be saved as JSON.
+
+Progress draws a live line with the throughput and the ETA of the copies,
+based on the planned bytes.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import threading
+import contextlib
+
+from playlisttools import humanize_number
+
+
+def format_rate(n, seconds, unit=''):
+    if not seconds:
+        return '-'
+    return '%.1f %s/s' % (n / seconds, unit) if unit else '%.0f/s' % (n / seconds)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%d h %02d min' % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '%d min %02d s' % (seconds // 60, seconds % 60)
+    return '%d s' % seconds
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase. The yielded dict takes its 'files' and 'bytes'."""
+        entry = {'name': name, 'seconds': None, 'files': 0, 'bytes': 0}
+        self.phases.append(entry)
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time.time() - start
+
+    def count(self, name, seconds, calls=1):
+        with self.lock:
+            counter = self.counters.setdefault(name, {'seconds': 0.,
+                                                      'calls': 0})
+            counter['seconds'] += seconds
+            counter['calls'] += calls
+
+    def timed(self, func, name, done=None):
+        """Wrap func to count the time of its calls under name, and call
+        done with the same arguments after each."""
+        def timed_func(*args):
+            start = time.time()
+            result = func(*args)
+            self.count(name, time.time() - start)
+            if done is not None:
+                done(*args)
+            return result
+        if hasattr(func, 'flush'):
+            timed_func.flush = func.flush
+        return timed_func
+
+    def as_dict(self):
+        return {'total_seconds': time.time() - self.start,
+                'phases': self.phases, 'counters': self.counters}
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        print("Timings:", file=file)
+        for entry in self.phases:
+            seconds = entry['seconds'] or 0.
+            line = "  %-20s %8.2f s" % (entry['name'], seconds)
+            if entry['files']:
+                line += "  %7d files (%s)" % (entry['files'],
+                                              format_rate(entry['files'], seconds))
+            if entry['bytes']:
+                line += "  %s (%s)" % (humanize_number(entry['bytes']),
+                        format_rate(entry['bytes'] / 1024.**2, seconds, 'MiB'))
+            print(line, file=file)
+        for name, counter in sorted(self.counters.items()):
+            print("  %-20s %8.2f s  in %d calls (summed over workers)" %
+                  (name, counter['seconds'], counter['calls']), file=file)
+        print("  %-20s %8.2f s" % ('total', time.time() - self.start),
+              file=file)
+
+    def save(self, filename):
+        with open(filename, 'w') as F:
+            json.dump(self.as_dict(), F, indent=2)
+
+
+class Progress(object):
+    """Live progress line of the copies, drawn on a terminal at most every
+    `interval` seconds."""
+
+    def __init__(self, total_bytes, total_files, file=None, interval=0.5):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.file = file or sys.stderr
+        self.interval = interval
+        self.enabled = hasattr(self.file, 'isatty') and self.file.isatty()
+        self.bytes = 0
+        self.files = 0
+        self.start = time.time()
+        self.drawn = 0
+        self.lock = threading.Lock()
+
+    def update(self, nbytes, nfiles=1):
+        with self.lock:
+            self.bytes += nbytes
+            self.files += nfiles
+            now = time.time()
+            if self.enabled and (now - self.drawn >= self.interval or
+                                 self.files == self.total_files):
+                self.drawn = now
+                self.draw(now - self.start)
+
+    def line(self, elapsed):
+        line = "%d/%d files, %s/%s" % (self.files, self.total_files,
+                                       humanize_number(self.bytes),
+                                       humanize_number(self.total_bytes))
+        if elapsed > 0 and self.bytes:
+            rate = self.bytes / elapsed
+            remaining = max(self.total_bytes - self.bytes, 0) / rate
+            line += ", %s, ETA %s" % (format_rate(self.bytes / 1024.**2,
+                                                  elapsed, 'MiB'),
+                                      format_duration(remaining))
+        return line
+
+    def draw(self, elapsed):
+        self.file.write('\r\x1b[K' + self.line(elapsed))
+        self.file.flush()
+
+    def finish(self):
+        if self.enabled and self.drawn:
+            self.file.write('\n')
+            self.file.flush()
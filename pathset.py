@@ -0,0 +1,180 @@
+"""
+Compact set of playlist paths.
+
+Playlists of millions of entries share a few directory prefixes: each path
+is stored as the id of its directory (stored once) and its file name, in
+insertion order. Entries are found by an open-addressing table of their
+indices in an array, instead of a set of the full path strings.
+
+Paths are rebuilt on iteration, and set operations stream over the entries.
+Random samples are drawn by index, flagging the excluded indices in a
+bytearray instead of building the complement.
+"""
+
+from __future__ import print_function
+
+import os
+from array import array
+from random import randrange, sample
+
+
+def split_path(path):
+    """(directory with its trailing separator, name): their concatenation
+    is the path."""
+    i = max(path.rfind('/'), path.rfind(os.sep)) + 1
+    return path[:i], path[i:]
+
+
+def sample_indices(n, k, excluded, randrange=randrange, sample=sample):
+    """k distinct random integers of range(n) whose flag in `excluded` (a
+    bytearray of n bytes) is not set. They are drawn by rejection while at
+    least half of the integers are allowed, otherwise from the list of the
+    allowed ones."""
+    nfree = n - excluded.count(1)
+    if k > nfree:
+        raise ValueError("sample larger than the allowed indices")
+    if nfree * 2 < n:
+        return sample([i for i in range(n) if not excluded[i]], k)
+    drawn = []
+    seen = set()
+    while len(drawn) < k:
+        i = randrange(n)
+        if not excluded[i] and i not in seen:
+            seen.add(i)
+            drawn.append(i)
+    return drawn
+
+
+class PathSet(object):
+    """Set of path strings, iterated in insertion order."""
+
+    def __init__(self, paths=()):
+        self.dirs = []
+        self.dirids = {}
+        self.entry_dirs = array('i')
+        self.names = []
+        self.table = array('q', [-1]) * 8
+        self.update(paths)
+
+    def slot(self, dirid, name):
+        """Position in the table of the entry (dirid, name), or of the free
+        slot where it goes."""
+        table = self.table
+        mask = len(table) - 1
+        h = hash(name) ^ dirid * 1000003
+        perturb = h & 0xffffffffffffffff
+        i = h & mask
+        while True:
+            index = table[i]
+            if index < 0 or (self.entry_dirs[index] == dirid and
+                             self.names[index] == name):
+                return i
+            perturb >>= 5
+            i = (i * 5 + perturb + 1) & mask
+
+    def add(self, path):
+        """Add path. Return whether it was new."""
+        return self.insert(*split_path(path))
+
+    def insert(self, dirname, name):
+        """Add the path dirname + name. Return whether it was new."""
+        dirid = self.dirids.get(dirname)
+        if dirid is None:
+            dirid = self.dirids[dirname] = len(self.dirs)
+            self.dirs.append(dirname)
+        i = self.slot(dirid, name)
+        if self.table[i] >= 0:
+            return False
+        self.table[i] = len(self.names)
+        self.entry_dirs.append(dirid)
+        self.names.append(name)
+        if len(self.names) * 3 >= len(self.table) * 2:
+            self.resize(len(self.table) * 2)
+        return True
+
+    def resize(self, size):
+        self.table = array('q', [-1]) * size
+        for index, (dirid, name) in enumerate(zip(self.entry_dirs,
+                                                  self.names)):
+            self.table[self.slot(dirid, name)] = index
+
+    def entries(self):
+        """Yield the (dirname, name) of the paths."""
+        dirs = self.dirs
+        for dirid, name in zip(self.entry_dirs, self.names):
+            yield dirs[dirid], name
+
+    def update(self, paths):
+        if isinstance(paths, PathSet):
+            for dirname, name in paths.entries():
+                self.insert(dirname, name)
+        else:
+            for path in paths:
+                self.add(path)
+
+    def find(self, dirname, name):
+        """Index of the path dirname + name in the insertion order, or -1."""
+        dirid = self.dirids.get(dirname)
+        if dirid is None:
+            return -1
+        return self.table[self.slot(dirid, name)]
+
+    def index(self, path):
+        """Index of path in the insertion order, or -1."""
+        return self.find(*split_path(path))
+
+    def __contains__(self, path):
+        return self.index(path) >= 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        return self.dirs[self.entry_dirs[index]] + self.names[index]
+
+    def __iter__(self):
+        for dirname, name in self.entries():
+            yield dirname + name
+
+    def union(self, paths):
+        result = PathSet(self)
+        result.update(paths)
+        return result
+
+    def difference(self, paths):
+        """The paths of self not in `paths` (a PathSet or a set)."""
+        result = PathSet()
+        if isinstance(paths, PathSet):
+            # Compared by entries, without building the path strings.
+            for dirname, name in self.entries():
+                if paths.find(dirname, name) < 0:
+                    result.insert(dirname, name)
+        else:
+            for dirname, name in self.entries():
+                if dirname + name not in paths:
+                    result.insert(dirname, name)
+        return result
+
+    __or__ = union
+    __sub__ = difference
+
+    def excluded(self, paths):
+        """bytearray flagging the indices of the paths of self in `paths`."""
+        flags = bytearray(len(self))
+        if isinstance(paths, PathSet):
+            entries = paths.entries()
+        else:
+            entries = (split_path(path) for path in paths)
+        for dirname, name in entries:
+            index = self.find(dirname, name)
+            if index >= 0:
+                flags[index] = 1
+        return flags
+
+    def sample(self, k, rng=None, exclude=()):
+        """PathSet of k random paths of self, not in `exclude`."""
+        kwargs = {} if rng is None else {'randrange': rng.randrange,
+                                         'sample': rng.sample}
+        indices = sample_indices(len(self), k, self.excluded(exclude),
+                                 **kwargs)
+        return PathSet(self[i] for i in indices)
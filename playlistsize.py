@@ -9,15 +9,22 @@ import argparse
 from playlisttools import get_playlist_filesize, humanize_number
 
 
-def main(playlistfile):
-    ntot, nf, bytesize = get_playlist_filesize(playlistfile)
+def main(playlistfile, threads=0):
+    ntot, nf, bytesize = get_playlist_filesize(playlistfile, threads)
     readablesize = humanize_number(bytesize)
     print("%d/%d files: %s (%s)" %(ntot - nf, ntot, bytesize, readablesize))
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(__doc__)
+def add_arguments(parser):
     parser.add_argument('playlistfile', nargs='?', type=argparse.FileType('r'),
                         default=stdin)
+    parser.add_argument('-t', '--threads', type=int, default=0,
+                        help='directories read concurrently, for network '
+                             'mounts [%(default)s]')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(__doc__)
+    add_arguments(parser)
     args = parser.parse_args()
-    main(args.playlistfile)
+    main(**vars(args))
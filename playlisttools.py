@@ -4,11 +4,16 @@
 from __future__ import print_function
 
 from sys import stderr, stdout
+import os
 import os.path as op
 from copy import copy
 import re
 
-from random import sample
+from random import sample, Random
+from array import array
+from bisect import bisect_left
+
+from pathset import PathSet, sample_indices
 
 try:
     # Python3
@@ -20,6 +25,8 @@ except ImportError:
 
 BIBYTES = ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']
 BIBYTES_PATTERN = r'^(\d+(?:\.\d+)?) ?(%s)B$' % (r'|'.join(BIBYTES))
+DURATION_UNITS = {'': 1, 's': 1, 'min': 60, 'h': 3600, 'd': 86400}
+DURATION_PATTERN = r'^(\d+(?:\.\d+)?) ?(%s)$' % (r'|'.join(DURATION_UNITS))
 
 
 def humanize_number(s):
@@ -53,12 +60,28 @@ def humannumber2int(bytesize):
     power = BIBYTES.index(unit)
 
     return round(float(number) * 1024**power)
+
+
+def humanduration2seconds(duration):
+    """Convert a duration such as 90min, 10h or 1:30:00 to seconds"""
+    duration = duration.strip()
+    if ':' in duration:
+        seconds = 0
+        for field in duration.split(':'):
+            seconds = seconds * 60 + float(field)
+        return seconds
+    match = re.match(DURATION_PATTERN, duration)
+    assert match, "invalid format"
+    number, unit = match.groups()
+    return float(number) * DURATION_UNITS[unit]
     
 
 def iter_playlist(playlistfile):
     """iterate over files from an m3u playlist:
         - unquote the url syntax;
         - do not output duplicates."""
+    # A builtin set: it only lives while reading, and is faster to fill than
+    # a PathSet.
     urlset = set()
 
     for rawline in playlistfile:
@@ -69,20 +92,123 @@ def iter_playlist(playlistfile):
                 yield unquote(line.replace('file://', ''))
 
 
-def get_playlist_filesize(playlistfile):
+def scan_sizes(dirname, names, mtimes=None):
+    """Return {name: size} for the files of names found in dirname, listing
+    the directory once. Their mtimes are stored in the `mtimes` dict if
+    given."""
+    sizes = {}
+
+    def add(name, st):
+        sizes[name] = st.st_size
+        if mtimes is not None:
+            mtimes[name] = st.st_mtime
+
+    try:
+        if hasattr(os, 'scandir'):
+            for entry in os.scandir(dirname or os.curdir):
+                if entry.name in names:
+                    try:
+                        add(entry.name, entry.stat())
+                    except OSError:
+                        pass
+        else:
+            for name in os.listdir(dirname or os.curdir):
+                if name in names:
+                    try:
+                        add(name, os.stat(op.join(dirname, name)))
+                    except OSError:
+                        pass
+    except OSError:
+        pass
+    # Names not listed as such (case-insensitive filesystems, unnormalized
+    # paths) are checked one by one.
+    for name in names:
+        if name not in sizes:
+            try:
+                add(name, os.stat(op.join(dirname, name)))
+            except OSError:
+                pass
+    return sizes
+
+
+def stat_paths(paths, threads=0, mtimes=None):
+    """Return {path: size} for the paths that are found, and store their
+    mtimes in the `mtimes` dict if given.
+
+    Paths are grouped by directory, and each directory is listed once. With
+    threads > 0, that many directories are read concurrently (useful on
+    high-latency network mounts)."""
+    bydir = {}
+    for path in paths:
+        dirname, name = op.split(path)
+        bydir.setdefault(dirname, {}).setdefault(name, []).append(path)
+
+    def scan(dirname):
+        dirmtimes = {} if mtimes is not None else None
+        dirsizes = scan_sizes(dirname, bydir[dirname], dirmtimes)
+        return dirname, dirsizes, dirmtimes
+
+    if threads > 0:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(scan, sorted(bydir)))
+    else:
+        results = [scan(dirname) for dirname in sorted(bydir)]
+
+    sizes = {}
+    for dirname, dirsizes, dirmtimes in results:
+        for name, size in dirsizes.items():
+            for path in bydir[dirname][name]:
+                sizes[path] = size
+                if mtimes is not None:
+                    mtimes[path] = dirmtimes[name]
+    return sizes
+
+
+def stat_entries(pathset, threads=0):
+    """Sizes of the paths of a PathSet, in an array indexed like it (-1 for
+    the paths not found). Directories are listed as in stat_paths, without
+    building the full path strings."""
+    bydir = {}
+    for index, (dirid, name) in enumerate(zip(pathset.entry_dirs,
+                                              pathset.names)):
+        bydir.setdefault(dirid, {})[name] = index
+
+    def scan(dirid):
+        # PathSet directories keep their trailing separator.
+        return dirid, scan_sizes(pathset.dirs[dirid].rstrip('/' + os.sep)
+                                 or pathset.dirs[dirid], bydir[dirid])
+
+    if threads > 0:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(scan, sorted(bydir)))
+    else:
+        results = [scan(dirid) for dirid in sorted(bydir)]
+
+    sizes = array('q', [-1]) * len(pathset)
+    for dirid, dirsizes in results:
+        indices = bydir[dirid]
+        for name, size in dirsizes.items():
+            sizes[indices[name]] = size
+    return sizes
+
+
+def get_playlist_filesize(playlistfile, threads=0):
     """Read a m3u playlist and output:
     - the number of different files referenced
     - number of unfound files
     - cumulated file size."""
     
-    ntot = 0
+    paths = list(iter_playlist(playlistfile))
+    sizes = stat_paths(paths, threads)
+    ntot = len(paths)
     notfound = 0
     s = 0
-    for path in iter_playlist(playlistfile):
-        ntot += 1
+    for path in paths:
         try:
-            s += op.getsize(path)
-        except OSError:
+            s += sizes[path]
+        except KeyError:
             print("Not found: %r" % path, file=stderr)
             notfound += 1
 
@@ -90,7 +216,8 @@ def get_playlist_filesize(playlistfile):
 
 
 def fixedsize_sample(urlset, maxsize="8GiB", epsilon="3MiB"):
-    """Random sample the urlset but try to get close to the maxsize."""
+    """Random sample the urlset but try to get close to the maxsize.
+    Return the size and the PathSet of the sample."""
 
     if isinstance(maxsize, str):
         maxsize = humannumber2int(maxsize)
@@ -99,10 +226,14 @@ def fixedsize_sample(urlset, maxsize="8GiB", epsilon="3MiB"):
     if isinstance(epsilon, str):
         epsilon = humannumber2int(epsilon)
 
-    N = len(urlset)
-    original_size = sum(op.getsize(path) for path in urlset)
+    paths = urlset if isinstance(urlset, PathSet) else PathSet(urlset)
+    N = len(paths)
+    sizes = array('q', (op.getsize(path) for path in paths))
+    original_size = sum(sizes)
     curr_size = 0
-    curr_set = set()
+    # Indices of the sampled paths, and their flags.
+    curr = []
+    chosen = bytearray(N)
 
     n_iter = 0
     max_iter = 500
@@ -120,19 +251,19 @@ def fixedsize_sample(urlset, maxsize="8GiB", epsilon="3MiB"):
         
         if space <= 0:
             # Files must be removed from the playlist
-            try:
-                removed_files = sample(curr_set, delta_n_files)
-            except ValueError:
-                print("space: %s, delta_n_files: %d" % (space, delta_n_files), file=stderr)
-            delta_size = - sum(op.getsize(f) for f in removed_files)
-            curr_set.difference_update(removed_files)
+            removed = sample(curr, min(delta_n_files, len(curr)))
+            for i in removed:
+                chosen[i] = 0
+            curr = [i for i in curr if chosen[i]]
+            delta_size = - sum(sizes[i] for i in removed)
         else:
-            try:
-                added_files = sample(urlset - curr_set, delta_n_files)
-            except ValueError:
-                print("space: %s, delta_n_files: %d" % (space, delta_n_files), file=stderr)
-            delta_size = sum(op.getsize(f) for f in added_files)
-            curr_set.update(added_files)
+            # Drawn among the files not sampled yet.
+            added = sample_indices(N, min(delta_n_files, N - len(curr)),
+                                   chosen)
+            for i in added:
+                chosen[i] = 1
+            curr.extend(added)
+            delta_size = sum(sizes[i] for i in added)
 
         curr_size += delta_size
 
@@ -141,7 +272,114 @@ def fixedsize_sample(urlset, maxsize="8GiB", epsilon="3MiB"):
     else:
         print("Converged in %d iterations." % n_iter, file=stderr)
 
-    return curr_size, curr_set
+    return curr_size, PathSet(paths[i] for i in sorted(curr))
+
+
+def stat_sizes(paths, threads=0):
+    """Stat each path once: return the list of found paths and the array of
+    their sizes."""
+    found = []
+    sizes = array('q')
+    pathsizes = stat_paths(paths, threads)
+    for path in paths:
+        try:
+            sizes.append(pathsizes[path])
+        except KeyError:
+            print("Not found: %r" % path, file=stderr)
+            continue
+        found.append(path)
+    return found, sizes
+
+
+def fill_capacity(sizes, low, high, rng, restarts=16, max_candidates=65536):
+    """Choose indices of `sizes` with a sum in [low, high).
+
+    Each try adds the items in a random order as long as they fit under
+    `high`, until the sum reaches `low`. If all items were tried, one chosen
+    item is swapped with one left out whose size differs by the right amount
+    (binary search among up to `max_candidates` sorted remaining sizes).
+    Each try is O(n), and at most `restarts` tries are made.
+    Return the sum and the list of indices (the best try if none succeeded).
+    """
+    n = len(sizes)
+    order = list(range(n))
+    best_total, best = 0, []
+    for _ in range(restarts):
+        total = 0
+        chosen = []
+        rest = []
+        for pos in range(n):
+            # Shuffle lazily (Fisher-Yates), as most tries stop early.
+            j = rng.randrange(pos, n)
+            order[pos], order[j] = order[j], order[pos]
+            i = order[pos]
+            if total + sizes[i] < high:
+                total += sizes[i]
+                chosen.append(i)
+                if total >= low:
+                    return total, chosen
+            else:
+                rest.append(i)
+
+        if rest:
+            # The order is random: a subset of the remaining items is enough
+            # to find a swap.
+            rest = rest[:max_candidates]
+            rest.sort(key=sizes.__getitem__)
+            rest_sizes = [sizes[j] for j in rest]
+            for k, i in enumerate(chosen):
+                # Need low <= total - sizes[i] + sizes[j] < high
+                pos = bisect_left(rest_sizes, sizes[i] + low - total)
+                if pos < len(rest) and \
+                        rest_sizes[pos] < sizes[i] + high - total:
+                    total += rest_sizes[pos] - sizes[i]
+                    chosen[k] = rest[pos]
+                    break
+
+        if total >= low:
+            return total, chosen
+        if total > best_total:
+            best_total, best = total, chosen
+        if not rest:
+            # Everything fits: no other try can do better.
+            break
+    return best_total, best
+
+
+def capacity_sample(urlset, maxsize="8GiB", epsilon="3MiB", seed=None,
+                    threads=0):
+    """Random sample the urlset with a cumulated size in
+    [maxsize - epsilon, maxsize), in bounded time (see fill_capacity).
+    The same seed gives the same sample of the same urlset (a PathSet, in
+    its order, or a set), returned as a PathSet. A PathSet is sampled by
+    index, without building its path strings."""
+
+    if isinstance(maxsize, str):
+        maxsize = humannumber2int(maxsize)
+
+    # Tolerated offset from the maxsize
+    if isinstance(epsilon, str):
+        epsilon = humannumber2int(epsilon)
+
+    if not isinstance(urlset, PathSet):
+        # Sorted, so that the sample only depends on the seed.
+        urlset = PathSet(sorted(urlset))
+    allsizes = stat_entries(urlset, threads)
+    found = array('i')
+    sizes = array('q')
+    for index, size in enumerate(allsizes):
+        if size < 0:
+            print("Not found: %r" % urlset[index], file=stderr)
+        else:
+            found.append(index)
+            sizes.append(size)
+    curr_size, chosen = fill_capacity(sizes, maxsize - epsilon, maxsize,
+                                      Random(seed))
+
+    if curr_size < maxsize - epsilon:
+        print("capacity_sample() could not reach the target size", file=stderr)
+
+    return curr_size, PathSet(urlset[found[i]] for i in sorted(chosen))
 
 
 def write_paths(paths, file=stdout, sort=True):
@@ -0,0 +1,122 @@
+"""
+Policies deciding what to do when a playlist track already exists in the
+destination, so that syncs can run unattended.
+
+A policy is a list of rules, tried in order until one decides. Rules are
+given as NAME or NAME:ARGUMENT:
+
+    bitrate[:KBPS]  replace if the new track has a higher bitrate (by at least
+                    KBPS), keep the existing one if it is lower;
+    length:SECONDS  keep the existing track if the durations differ by at most
+                    SECONDS;
+    prefer:EXT      replace by a track of this extension, keep an existing
+                    track of this extension;
+    replace, ignore, alongside
+                    always take this decision;
+    ask             ask interactively.
+
+Decisions are the answers of the interactive prompt: 'r' (replace), 'i'
+(ignore) and 'c' (copy alongside). As in the prompt, replacing a track that
+has the same file name just copies over it (or next to it, in another
+directory).
+"""
+
+from __future__ import print_function
+
+import os.path as op
+
+
+ANSWERS = {'r': 'replace', 'i': 'ignore', 'c': 'alongside'}
+
+RULES = {}
+
+
+def rule(name):
+    def register(func):
+        RULES[name] = func
+        return func
+    return register
+
+
+@rule('bitrate')
+def higher_bitrate(src, dst, kbps='0'):
+    gain = float(kbps) * 1000
+    if src.bitrate is None or dst.bitrate is None:
+        return None
+    if src.bitrate - dst.bitrate > gain:
+        return 'r'
+    if src.bitrate < dst.bitrate:
+        return 'i'
+
+
+@rule('length')
+def same_length(src, dst, seconds='2'):
+    if src.length is None or dst.length is None:
+        return None
+    if abs(src.length - dst.length) <= float(seconds):
+        return 'i'
+
+
+@rule('prefer')
+def prefer_extension(src, dst, ext):
+    ext = '.' + ext.lstrip('.').lower()
+    src_ext = op.splitext(src.path)[1].lower()
+    dst_ext = op.splitext(dst.path)[1].lower()
+    if src_ext == dst_ext:
+        return None
+    if src_ext == ext:
+        return 'r'
+    if dst_ext == ext:
+        return 'i'
+
+
+@rule('replace')
+def always_replace(src, dst):
+    return 'r'
+
+
+@rule('ignore')
+def always_ignore(src, dst):
+    return 'i'
+
+
+@rule('alongside')
+def always_alongside(src, dst):
+    return 'c'
+
+
+def parse_rule(spec):
+    """'length:2' -> ('length', ['2'])"""
+    name, _, arg = spec.partition(':')
+    if name != 'ask' and name not in RULES:
+        raise ValueError("Unknown conflict rule: %r (known: %s)" %
+                         (name, ', '.join(sorted(RULES) + ['ask'])))
+    if name == 'prefer' and not arg:
+        raise ValueError("The prefer rule needs an extension, e.g. prefer:flac")
+    return name, [arg] if arg else []
+
+
+class Policy(object):
+    """Ordered conflict rules. When no rule decides, `ask(src, dst,
+    same_name)` is called (the interactive prompt), or the track is
+    ignored if there is none."""
+
+    def __init__(self, specs=('ask',), ask=None):
+        self.rules = [parse_rule(spec) for spec in specs]
+        self.ask = ask
+
+    def decide(self, src, dst, same_name=False):
+        """Return the decision and the rule that took it."""
+        for name, args in self.rules:
+            if name == 'ask':
+                if self.ask is None:
+                    continue
+                answer = self.ask(src, dst, same_name)
+            else:
+                answer = RULES[name](src, dst, *args)
+            if answer is not None:
+                break
+        else:
+            name = 'default'
+            answer = 'i' if self.ask is None else self.ask(src, dst, same_name)
+        return answer, name
@@ -0,0 +1,153 @@
+"""
+Snapshot of the last successful coolsync run, kept on the destination.
+
+It records each playlist entry that was synced, with its size and mtime and
+the destination track it maps to, and the tags of all the tracks of the
+destination. The next run only reads the tags of the entries that were
+added or changed since, and takes the destination tracks from the snapshot
+instead of scanning the device.
+
+A snapshot is only used if the destination has not been modified since:
+a fingerprint of the mtimes of the destination root and of the directories
+of its tracks (which change when files are added, removed or renamed in
+them), and of the stat of the snapshot file itself, is kept in the user
+cache directory right after the snapshot is written, and compared. Tracks
+modified in place (e.g. retagged) are not detected: use --full-scan then.
+The snapshot is also discarded when the settings mapping entries to
+destination paths (pattern, local directories, naming rules, transcoding)
+differ.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import json
+import uuid
+import hashlib
+
+from catalog import Catalog
+from tagcache import USER_CACHE_DIR
+
+
+SNAPSHOT_FILENAME = '.coolsync-snapshot.json'
+FINGERPRINTS = op.join(USER_CACHE_DIR, 'snapshots.json')
+VERSION = 1
+
+
+def fingerprint(destdir, tracks, snapshot):
+    """Digest of the mtimes of destdir and of the directories of the tracks
+    (paths relative to destdir), and of the stat of the snapshot file."""
+    dirs = set([''])
+    for track in tracks:
+        dirname = op.dirname(track)
+        while dirname not in dirs:
+            dirs.add(dirname)
+            dirname = op.dirname(dirname)
+    digest = hashlib.sha1()
+    for dirname in sorted(dirs):
+        try:
+            mtime = os.stat(op.join(destdir, dirname)).st_mtime
+        except OSError:
+            mtime = None
+        digest.update(repr((dirname, mtime)).encode('utf-8'))
+    st = os.stat(snapshot)
+    digest.update(repr((st.st_ino, st.st_size, st.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_fingerprints(filename=FINGERPRINTS):
+    try:
+        with open(filename) as F:
+            return json.load(F)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+class Snapshot(object):
+
+    def __init__(self, destdir, fingerprints=FINGERPRINTS):
+        self.destdir = destdir
+        self.path = op.join(destdir, SNAPSHOT_FILENAME)
+        self.fingerprints = fingerprints
+        self.entries = {}
+        self.tracks = {}
+        self.id = None
+        self.reason = None
+
+    def load(self, settings):
+        """Read the snapshot. Return False (and the reason in `reason`) if
+        it is missing, was taken with other settings, or the device has
+        changed since."""
+        try:
+            with open(self.path) as F:
+                data = json.load(F)
+        except (IOError, OSError, ValueError):
+            self.reason = "no snapshot"
+            return False
+        self.id = data.get('id')
+        if data.get('version') != VERSION or data.get('settings') != settings:
+            self.reason = "settings changed"
+            return False
+        if read_fingerprints(self.fingerprints).get(data['id']) != \
+                fingerprint(self.destdir, data['tracks'], self.path):
+            self.reason = "device modified"
+            return False
+        self.entries = dict((src, (size, mtime, op.join(self.destdir, dst)))
+                            for src, (size, mtime, dst)
+                            in data['entries'].items())
+        self.tracks = data['tracks']
+        return True
+
+    def diff(self, sizes, mtimes, missing=()):
+        """Compare the found entries of the playlist ({path: size} and
+        {path: mtime}) to the snapshot. Return the sets of added, changed
+        and removed entries. The `missing` entries (not found) are not
+        removed: their copies are kept as they are."""
+        added, changed = set(), set()
+        for src, size in sizes.items():
+            if src not in self.entries:
+                added.add(src)
+            elif self.entries[src][:2] != (size, mtimes[src]):
+                changed.add(src)
+        removed = set(self.entries) - set(sizes) - set(missing)
+        return added, changed, removed
+
+    def catalog(self):
+        """The destination tracks, as dir_audioscan would find them."""
+        catalog = Catalog(normalized=True)
+        for dst, (record, tagged) in self.tracks.items():
+            for k, value in record.items():
+                # JSON has no tuples (m4a track numbers)
+                if isinstance(value, list):
+                    record[k] = tuple(value)
+            catalog.add(op.join(self.destdir, dst), record, tagged)
+        return catalog
+
+    def save(self, settings, entries, catalog):
+        """Write the snapshot of the synced entries ({src: (size, mtime,
+        dst)}) and of the destination tracks (catalog), then record the
+        fingerprint of the device."""
+        data = {'version': VERSION, 'id': uuid.uuid4().hex,
+                'settings': settings,
+                'entries': dict((src, (size, mtime,
+                                       op.relpath(dst, self.destdir)))
+                                for src, (size, mtime, dst) in entries.items()),
+                'tracks': dict((op.relpath(path, self.destdir),
+                                (catalog[path].record(), catalog[path].tagged))
+                               for path in catalog)}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as F:
+            json.dump(data, F, default=str)
+            F.flush()
+            os.fsync(F.fileno())
+        os.rename(tmp, self.path)
+        fingerprints = read_fingerprints(self.fingerprints)
+        fingerprints.pop(self.id, None)
+        self.id = data['id']
+        fingerprints[data['id']] = fingerprint(self.destdir, data['tracks'],
+                                               self.path)
+        if not op.isdir(op.dirname(self.fingerprints)):
+            os.makedirs(op.dirname(self.fingerprints))
+        with open(self.fingerprints, 'w') as F:
+            json.dump(fingerprints, F)
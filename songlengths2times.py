@@ -1,45 +1,241 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+"""Start time of each song of a playlist, from the song durations.
 
+Inputs are m3u playlists, whose durations are taken from their #EXTINF
+lines or else read from the files (in parallel, and kept in the tag cache of
+coolsync), or tab-separated "song<TAB>[H:]MM:SS" lines (stdin by default).
+The output is a list of start times, a cue sheet or ffmpeg chapters."""
+
+from __future__ import print_function
+
+import os
+import os.path as op
 import sys
 import argparse as ap
-import datetime as dt
+
+try:
+    # Python3
+    from urllib.parse import unquote
+except ImportError:
+    # Python2
+    from urllib import unquote
+
+
+PLAYLIST_EXTS = ('.m3u', '.m3u8')
+OUTPUT_EXTS = {'list': '.txt', 'cue': '.cue', 'chapters': '.ffmetadata'}
+
+
+def parse_duration(text):
+    """'[H:]MM:SS[.sss]' -> milliseconds."""
+    fields = text.strip().split(':')
+    seconds = 0
+    for field in fields[:-1]:
+        seconds = seconds * 60 + int(field)
+    return int(round((seconds * 60 + float(fields[-1])) * 1000))
 
 
 def parse_songlengths(stream=sys.stdin):
-    return [line.rstrip().split('\t') for line in stream]
+    """[(song, milliseconds)] of "song<TAB>duration" lines."""
+    songlengths = []
+    for line in stream:
+        if line.strip():
+            song, length = line.rstrip('\r\n').rsplit('\t', 1)
+            songlengths.append((song, parse_duration(length)))
+    return songlengths
 
 
-def lengths2times(songlengths, tfmt='%M:%S'):
-    time0 = dt.datetime(1, 1, 1)
-    songtimes = []
-    prev_td = dt.timedelta()
-    for song, length in songlengths:
-        start_time = (time0 + prev_td)
-        out_fmt = '%H:%M:%S' if prev_td.total_seconds() > 3600 else '%M:%S'
-        songtimes.append(start_time.strftime(out_fmt))
+def read_m3u(playlistfile):
+    """[[title, path, milliseconds]] of the entries of the playlist. The
+    title and duration are None when there is no #EXTINF line (or a
+    negative duration, for streams)."""
+    dirname = op.dirname(op.abspath(playlistfile))
+    entries = []
+    extinf = None
+    with open(playlistfile) as F:
+        for line in F:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration, _, title = line[len('#EXTINF:'):].partition(',')
+                try:
+                    # Extended EXTINF lines have attributes after the duration.
+                    length = int(round(float(duration.split()[0]) * 1000))
+                except (ValueError, IndexError):
+                    length = None
+                if length is not None and length < 0:
+                    length = None
+                extinf = (title.strip() or None, length)
+            elif line and not line.startswith('#'):
+                path = unquote(line.replace('file://', ''))
+                if '://' not in path and not op.isabs(path):
+                    path = op.join(dirname, path)
+                title, length = extinf or (None, None)
+                entries.append([title, path, length])
+                extinf = None
+    return entries
 
-        t = dt.datetime.strptime(length, tfmt)
-        td = dt.timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
-        prev_td += td
-    total_time = time0 + prev_td
-    out_fmt = '%H:%M:%S' if prev_td.total_seconds() > 3600 else '%M:%S'
-    return songtimes, total_time.strftime(out_fmt)
 
+def probe_lengths(paths, jobs=1, cache=True):
+    """{path: Track} of the existing files, read by coolsync (the tag cache
+    keeps the lengths of unchanged files), and {path: reason} of the files
+    that could not be read."""
+    from coolsync import scan_audiofiles
+    from catalog import Catalog
+    from tagcache import TagCache
+    found = sorted(path for path in set(paths) if op.exists(path))
+    catalog = Catalog()
+    tagcache = TagCache(os.sep) if cache else None
+    errors = []
+    try:
+        scan_audiofiles(found, catalog, tagcache, jobs, errors=errors)
+    finally:
+        if tagcache is not None:
+            tagcache.close()
+    return dict((path, catalog[path]) for path in catalog), dict(errors)
 
-def main():
-    parser = ap.ArgumentParser(description=__doc__)
-    parser.add_argument('songlengths', nargs='?', type=ap.FileType('r'), default=sys.stdin)
-    args = parser.parse_args()
-    
-    songlengths = parse_songlengths(args.songlengths)
-    songtimes, total_length = lengths2times(songlengths)
 
-    for (song, _), t in zip(songlengths, songtimes):
-        print('%s    %s' % (t, song))
-    print('Total:   %s' % total_length)
+def song_title(path, track=None):
+    if track is not None and track.title is not None:
+        if track.artist is not None:
+            return u'%s - %s' % (track.artist, track.title)
+        return track.title
+    return op.splitext(op.basename(path))[0]
+
+
+def lengths2times(lengths):
+    """Start times of songs of the given lengths, and the total length (in
+    milliseconds)."""
+    starts = []
+    total = 0
+    for length in lengths:
+        starts.append(total)
+        total += length
+    return starts, total
+
+
+def format_time(ms):
+    """MM:SS, or H:MM:SS from one hour."""
+    seconds = ms // 1000
+    if seconds >= 3600:
+        return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                                 seconds % 60)
+    return '%02d:%02d' % (seconds // 60, seconds % 60)
+
+
+def write_list(songs, starts, total, out, name=None):
+    for song, start in zip(songs, starts):
+        print('%s    %s' % (format_time(start), song), file=out)
+    print('Total:   %s' % format_time(total), file=out)
+
+
+def write_cue(songs, starts, total, out, name=None, audiofile=None):
+    """Cue sheet of the songs, as tracks of one audio file (e.g. the
+    recording of the playlist)."""
+    def quoted(text):
+        return '"%s"' % text.replace('"', "'")
+    if name:
+        print('TITLE %s' % quoted(name), file=out)
+    print('FILE %s WAVE' % quoted(audiofile or (name or 'playlist') + '.wav'),
+          file=out)
+    for i, (song, start) in enumerate(zip(songs, starts)):
+        # Cue sheets count in frames of 1/75 s.
+        frames = start * 75 // 1000
+        print('  TRACK %02d AUDIO' % (i + 1), file=out)
+        print('    TITLE %s' % quoted(song), file=out)
+        print('    INDEX 01 %02d:%02d:%02d' % (frames // (75 * 60),
+              frames // 75 % 60, frames % 75), file=out)
+
+
+def write_chapters(songs, starts, total, out, name=None):
+    """Chapters in the ffmetadata format (ffmpeg -i FILE -i CHAPTERS
+    -map_metadata 1 ...)."""
+    def escaped(text):
+        for c in '\\=;#\n':
+            text = text.replace(c, '\\' + c)
+        return text
+    print(';FFMETADATA1', file=out)
+    if name:
+        print('title=%s' % escaped(name), file=out)
+    ends = starts[1:] + [total]
+    for song, start, end in zip(songs, starts, ends):
+        print('\n[CHAPTER]\nTIMEBASE=1/1000\nSTART=%d\nEND=%d\ntitle=%s' %
+              (start, end, escaped(song)), file=out)
+
+
+WRITERS = {'list': write_list, 'cue': write_cue, 'chapters': write_chapters}
+
+
+def main(inputs, format='list', outdir=None, jobs=1, cache=True):
+    # Read all the inputs first, to probe the missing durations at once.
+    songlists = []
+    for filename in inputs or ['-']:
+        if filename == '-':
+            songlists.append(('-', parse_songlengths(sys.stdin)))
+        elif filename.lower().endswith(PLAYLIST_EXTS):
+            songlists.append((filename, read_m3u(filename)))
+        else:
+            with open(filename) as F:
+                songlists.append((filename, parse_songlengths(F)))
+    unknown = [entry[1] for _, entries in songlists for entry in entries
+               if len(entry) == 3 and entry[2] is None]
+    tracks, errors = probe_lengths(unknown, jobs, cache) if unknown else \
+                     ({}, {})
+
+    status = None
+    for filename, entries in songlists:
+        songs, lengths = [], []
+        for entry in entries:
+            if len(entry) == 2:
+                song, length = entry
+            else:
+                title, path, length = entry
+                track = tracks.get(path)
+                if length is None:
+                    if track is None or track.length is None:
+                        reason = errors.get(path) or ('no duration' if track
+                                                      else 'not found')
+                        print("Unknown duration, skipped: %r (%s)" %
+                              (path, reason), file=sys.stderr)
+                        status = 1
+                        continue
+                    length = int(round(track.length * 1000))
+                song = title or song_title(path, track)
+            songs.append(song)
+            lengths.append(length)
+        starts, total = lengths2times(lengths)
+        name = None if filename == '-' else \
+               op.splitext(op.basename(filename))[0]
+        if outdir:
+            outfile = op.join(outdir, (name or 'stdin') + OUTPUT_EXTS[format])
+            with open(outfile, 'w') as out:
+                WRITERS[format](songs, starts, total, out, name)
+        else:
+            if len(songlists) > 1:
+                print('==> %s <==' % filename)
+            WRITERS[format](songs, starts, total, sys.stdout, name)
+    return status
+
+
+def add_arguments(parser):
+    parser.add_argument('inputs', nargs='*',
+                        help='m3u playlists (.m3u, .m3u8) or song<TAB>length '
+                             'files [stdin]')
+    parser.add_argument('-f', '--format', default='list',
+                        choices=sorted(WRITERS),
+                        help='output format [%(default)s]')
+    parser.add_argument('-o', '--outdir',
+                        help='write the output of each input to OUTDIR/'
+                             'NAME.txt/.cue/.ffmetadata [stdout]')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes reading the durations of '
+                             'the files [%(default)s]')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not use the tag cache of coolsync')
 
 
 if __name__ == '__main__':
-    main()
+    parser = ap.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,84 @@
+"""
+Serializable plan of a coolsync run.
+
+A plan is the list of operations (dicts) applied by coolsync:
+
+    remove:  delete the existing track 'dst', replaced by another (or not in
+             the playlist, in mirror mode);
+    copy:    copy 'src' ('size' bytes) to 'dst';
+    skip:    'src' is already present as another track.
+
+Copies, skips and mirror removals are in one of the categories below, with
+the 'bytes' written and 'freed' on the destination (rounded up to its
+clusters), and the 'conflicts' decided with existing tracks, if any.
+
+Plans are saved as JSON, with destination paths relative to the destination
+directory, so that they can be computed ahead and applied when the device is
+mounted.
+"""
+
+from __future__ import print_function
+
+import os.path as op
+import json
+
+
+CATEGORIES = ('new',        # copied to a free path;
+              'overwrite',  # copied over an untracked file at the same path;
+              'replace',    # replaces existing tracks with the same tags;
+              'alongside',  # copied next to tracks with the same tags;
+              'present',    # same tags as existing tracks, ignored;
+              'stale')      # not in the playlist, removed (mirror mode).
+
+VERSION = 1
+
+
+def summarize(ops):
+    """Return {category: [files, bytes written, bytes freed]}."""
+    summary = dict((category, [0, 0, 0]) for category in CATEGORIES)
+    for op_ in ops:
+        if 'category' in op_:
+            counts = summary[op_['category']]
+            counts[0] += 1
+            counts[1] += op_['bytes']
+            counts[2] += op_['freed']
+    return summary
+
+
+def sort_operations(ops):
+    """Removals first (to free space), then the copies grouped by destination
+    directory, for locality of the writes on flash media."""
+    removals = [op_ for op_ in ops if op_['op'] == 'remove']
+    others = [op_ for op_ in ops if op_['op'] != 'remove']
+    return sorted(removals, key=lambda op_: op_['dst']) + \
+           sorted(others, key=lambda op_: op.split(op_['dst']))
+
+
+def map_destinations(ops, func):
+    for op_ in ops:
+        op_['dst'] = func(op_['dst'])
+        for conflict in op_.get('conflicts', []):
+            conflict['dst'] = func(conflict['dst'])
+    return ops
+
+
+def save_plan(ops, destdir, filename):
+    destdir = op.abspath(destdir)
+    ops = [dict(op_) for op_ in ops]
+    for op_ in ops:
+        if 'conflicts' in op_:
+            op_['conflicts'] = [dict(c) for c in op_['conflicts']]
+    map_destinations(ops, lambda path: op.relpath(path, destdir))
+    with open(filename, 'w') as F:
+        json.dump({'version': VERSION, 'destdir': destdir, 'operations': ops},
+                  F, indent=0)
+
+
+def load_plan(filename, destdir):
+    """Operations of a saved plan, applied to destdir."""
+    with open(filename) as F:
+        plan = json.load(F)
+    if plan.get('version') != VERSION:
+        raise ValueError("Unsupported plan version: %r" % plan.get('version'))
+    return map_destinations(plan['operations'],
+                            lambda path: op.join(destdir, path))
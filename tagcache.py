@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Persistent cache of the audio tags read by coolsync.
+
+One SQLite file is kept per library root. Entries are keyed by the path
+relative to that root, and are only reused while the size, mtime and inode
+of the file are unchanged.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import sys
+import json
+import sqlite3
+import argparse
+
+
+CACHE_FILENAME = '.coolsync-tags.sqlite'
+USER_CACHE_DIR = op.expanduser('~/.cache/coolsync')
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS tags (
+    path  TEXT PRIMARY KEY,
+    size  INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    data  TEXT
+)"""
+
+
+def default_cachefile(root):
+    """Location of the cache for a library root: inside the root itself, or
+    in the user cache directory for the root of the filesystem (used for
+    playlist entries, which can be anywhere)."""
+    if op.abspath(root) == os.sep:
+        return op.join(USER_CACHE_DIR, 'tags.sqlite')
+    return op.join(root, CACHE_FILENAME)
+
+
+class TagCache(object):
+    """Map audio file paths to the (record, tagged) pair of `read_audiotags`."""
+
+    def __init__(self, root, cachefile=None):
+        self.root = op.abspath(root)
+        self.cachefile = cachefile or default_cachefile(self.root)
+        cachedir = op.dirname(self.cachefile)
+        if not op.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.db = sqlite3.connect(self.cachefile)
+        self.db.execute(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path):
+        return op.relpath(op.abspath(path), self.root)
+
+    def get(self, path, st=None):
+        """Return the cached (record, tagged) of path, or None if it is
+        missing or stale."""
+        if st is None:
+            st = os.stat(path)
+        row = self.db.execute('SELECT size, mtime, inode, data FROM tags '
+                              'WHERE path = ?', (self.key(path),)).fetchone()
+        if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime, st.st_ino):
+            self.misses += 1
+            return None
+        self.hits += 1
+        record, tagged = json.loads(row[3])
+        # JSON has no tuples (m4a track numbers are (n, total) pairs).
+        for k, value in record.items():
+            if isinstance(value, list):
+                record[k] = tuple(value)
+        return record, tagged
+
+    def put(self, path, record, tagged, st=None):
+        if st is None:
+            st = os.stat(path)
+        # Tag values that are not plain strings/numbers (e.g. ID3 timestamps)
+        # are stored as their string representation.
+        data = json.dumps([record, tagged], default=str)
+        self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?)',
+                        (self.key(path), st.st_size, st.st_mtime, st.st_ino,
+                         data))
+
+    def retain(self, paths):
+        """Drop the entries of files not in paths (e.g. deleted since)."""
+        keep = set(self.key(path) for path in paths)
+        stale = [(key,) for (key,) in self.db.execute('SELECT path FROM tags')
+                 if key not in keep]
+        self.db.executemany('DELETE FROM tags WHERE path = ?', stale)
+        return len(stale)
+
+    def invalidate(self, path=None):
+        """Drop all entries, or only those of path and the files below it."""
+        if path is None:
+            cursor = self.db.execute('DELETE FROM tags')
+        else:
+            key = self.key(path)
+            prefix = key.replace('\\', '\\\\').replace('%', '\\%')\
+                        .replace('_', '\\_') + '/%'
+            cursor = self.db.execute("DELETE FROM tags WHERE path = ? "
+                                     "OR path LIKE ? ESCAPE '\\'",
+                                     (key, prefix))
+        self.db.commit()
+        return cursor.rowcount
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+
+    def stats(self):
+        return "Tag cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def main(root, cachefile=None, invalidate=None):
+    cache = TagCache(root, cachefile)
+    if invalidate is not None:
+        paths = invalidate or [None]
+        n = sum(cache.invalidate(path) for path in paths)
+        print("Invalidated %d entries" % n, file=sys.stderr)
+    print("%s: %d entries" % (cache.cachefile, len(cache)))
+    cache.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('root', help='root of the music library')
+    parser.add_argument('-f', '--cachefile',
+                        help='cache file [ROOT/%s]' % CACHE_FILENAME)
+    parser.add_argument('-i', '--invalidate', nargs='*', metavar='PATH',
+                        help='drop the cache entries of the given files/'
+                             'directories (everything if none given)')
+    args = parser.parse_args()
+    main(**vars(args))
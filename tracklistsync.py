@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Playlist tools, as subcommands: sync the tracks of a playlist to devices,
+print its size, sample it, or list the start times of its songs.
+
+Only the module of the chosen subcommand is imported (mutagen and the sync
+engines are not loaded to print a playlist size).
+"""
+
+from __future__ import print_function
+
+import time
+START = time.time()
+
+import sys
+import argparse
+from importlib import import_module
+
+
+# subcommand: (module, help)
+COMMANDS = [('sync', ('coolsync', 'copy the tracks of a playlist to '
+                                  'directories/devices')),
+            ('size', ('playlistsize', 'print the total size of the files of '
+                                      'a playlist')),
+            ('sample', ('m3u_sample', 'randomly select tracks of a playlist, '
+                                      'within size and duration budgets')),
+            ('times', ('songlengths2times', 'start time of each song of '
+                                            'playlists, cue sheets, chapters'))]
+
+
+def startup_profile(modules_before, import_seconds, file=sys.stderr):
+    """Print the startup time and the modules imported by the subcommand."""
+    added = sorted(set(sys.modules) - modules_before)
+    packages = sorted(set(name.split('.')[0] for name in added))
+    print("Startup: %.1f ms, subcommand imports %.1f ms (%d modules: %s)"
+          % ((time.time() - START) * 1000, import_seconds * 1000, len(added),
+             ' '.join(packages)), file=file)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the startup time and the imported modules '
+                             '(see also python -X importtime)')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    # The modules only define their arguments when their subcommand is
+    # called: the others are not imported.
+    chosen = [arg for arg in argv if not arg.startswith('-')][:1]
+    module = None
+    modules_before = set(sys.modules)
+    import_seconds = 0
+    for name, (modname, help) in COMMANDS:
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        if [name] == chosen:
+            start = time.time()
+            module = import_module(modname)
+            import_seconds = time.time() - start
+            module.add_arguments(subparser)
+            chosen_parser = subparser
+    args = parser.parse_args(argv)
+    if module is None:
+        parser.error("a subcommand is required")
+    if args.profile_startup:
+        startup_profile(modules_before, import_seconds)
+    del args.command, args.profile_startup
+    if hasattr(module, 'run'):
+        return module.run(args, chosen_parser)
+    return module.main(**vars(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
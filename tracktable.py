@@ -0,0 +1,180 @@
+"""
+Column table of the tracks of a playlist, and sampling under several budgets.
+
+The table keeps one array per column (size, length, artist id, album id),
+indexed like the sorted list of paths, so that sampling loops over flat
+arrays instead of Track objects. Tags come from coolsync (and its tag cache),
+and are only read when a budget or the stratification needs them.
+
+The sample fills the byte budget (like fill_capacity) without exceeding the
+total duration nor the number of tracks per artist/album. Stratified samples
+visit the tracks round-robin over the artists (or albums), in a random order
+at each round, so that each artist gets the same chances.
+"""
+
+from __future__ import print_function
+
+from sys import stderr
+from random import Random
+from array import array
+
+from pathset import PathSet
+from playlisttools import stat_sizes, humannumber2int, humanduration2seconds
+
+
+STRATA = ('artist', 'album')
+
+
+class TrackTable(object):
+    """Columns of the tracks: paths, sizes (bytes), lengths (seconds), and
+    the ids of their artist and album (untagged tracks share the id of the
+    None artist/album)."""
+
+    def __init__(self, paths, sizes, lengths=None, artists=None, albums=None):
+        n = len(paths)
+        self.paths = paths
+        self.sizes = sizes
+        self.lengths = array('d', [0.]) * n if lengths is None else lengths
+        self.artists = array('i', [0]) * n if artists is None else artists
+        self.albums = array('i', [0]) * n if albums is None else albums
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def from_paths(cls, paths, tags=True, threads=0, jobs=1, cache=True):
+        """Table of the found paths, in sorted order. The tags are read with
+        coolsync if `tags`: the files that cannot be read are reported, and
+        counted as untagged, of length 0."""
+        paths, sizes = stat_sizes(sorted(paths), threads)
+        if not tags:
+            return cls(paths, sizes)
+        from coolsync import read_tags
+        errors = []
+        catalog = read_tags(paths, cache, jobs, errors=errors)
+        for path, reason in errors:
+            print("Unreadable tags: %r (%s)" % (path, reason), file=stderr)
+        lengths = array('d')
+        artists = array('i')
+        albums = array('i')
+        artistids = {}
+        albumids = {}
+        for path in paths:
+            track = catalog.get(path)
+            if track is None:
+                length, artist, album = 0., None, None
+            else:
+                length, artist, album = (track.length or 0., track.artist,
+                                         track.album)
+            lengths.append(length)
+            artists.append(artistids.setdefault(artist, len(artistids)))
+            albums.append(albumids.setdefault((artist, album), len(albumids)))
+        return cls(paths, sizes, lengths, artists, albums)
+
+
+def random_order(n, rng):
+    """Yield the indices of range(n) in a random order, shuffled lazily
+    (Fisher-Yates), as the sampling often stops early."""
+    order = list(range(n))
+    for pos in range(n):
+        j = rng.randrange(pos, n)
+        order[pos], order[j] = order[j], order[pos]
+        yield order[pos]
+
+
+def stratified_order(groups, rng):
+    """Indices of `groups` (array of group ids, from 0) round-robin over the
+    groups: one random track of each group, in a random group order, then a
+    second one, etc."""
+    order = list(range(len(groups)))
+    rng.shuffle(order)
+    ranks = array('i', [0]) * len(groups)
+    seen = array('i', [0]) * (max(groups) + 1 if groups else 0)
+    for i in order:
+        g = groups[i]
+        ranks[i] = seen[g]
+        seen[g] += 1
+    # Stable: within a round, the groups stay in the shuffled order.
+    order.sort(key=ranks.__getitem__)
+    return order
+
+
+def fill_budgets(table, low, high, maxlength=None, per_artist=None,
+                 per_album=None, stratify=None, rng=None):
+    """Choose indices of the table with a sum of sizes in [low, high), a sum
+    of lengths <= maxlength, and at most per_artist/per_album tracks of each
+    artist/album. Tracks are tried once each, in a random (or stratified)
+    order, in O(n) (O(n log n) when stratified).
+    Return the sum of sizes, the sum of lengths and the list of indices."""
+    rng = rng or Random()
+    n = len(table)
+    if stratify == 'artist':
+        order = stratified_order(table.artists, rng)
+    elif stratify == 'album':
+        order = stratified_order(table.albums, rng)
+    else:
+        order = random_order(n, rng)
+    sizes, lengths = table.sizes, table.lengths
+    artists, albums = table.artists, table.albums
+    maxlength = float('inf') if maxlength is None else maxlength
+    artist_counts = {}
+    album_counts = {}
+    total = 0
+    total_length = 0.
+    chosen = []
+    for i in order:
+        if total + sizes[i] >= high or total_length + lengths[i] > maxlength:
+            continue
+        if per_artist is not None:
+            count = artist_counts.get(artists[i], 0)
+            if count >= per_artist:
+                continue
+        if per_album is not None:
+            count = album_counts.get(albums[i], 0)
+            if count >= per_album:
+                continue
+        total += sizes[i]
+        total_length += lengths[i]
+        chosen.append(i)
+        if per_artist is not None:
+            artist_counts[artists[i]] = artist_counts.get(artists[i], 0) + 1
+        if per_album is not None:
+            album_counts[albums[i]] = album_counts.get(albums[i], 0) + 1
+        if total >= low:
+            break
+    return total, total_length, chosen
+
+
+def budget_sample(urlset, maxsize="8GiB", epsilon="3MiB", maxlength=None,
+                  per_artist=None, per_album=None, stratify=None, seed=None,
+                  threads=0, jobs=1):
+    """Random sample the urlset under all the budgets (see fill_budgets).
+    The same seed gives the same sample, returned as a PathSet with its size
+    and length."""
+
+    if isinstance(maxsize, str):
+        maxsize = humannumber2int(maxsize)
+
+    # Tolerated offset from the maxsize
+    if isinstance(epsilon, str):
+        epsilon = humannumber2int(epsilon)
+
+    if isinstance(maxlength, str):
+        maxlength = humanduration2seconds(maxlength)
+
+    if stratify is not None and stratify not in STRATA:
+        raise ValueError("Invalid stratification %r (expected one of %s)"
+                         % (stratify, ', '.join(STRATA)))
+
+    tags = maxlength is not None or per_artist is not None or \
+           per_album is not None or stratify is not None
+    table = TrackTable.from_paths(urlset, tags, threads, jobs)
+    curr_size, curr_length, chosen = fill_budgets(
+            table, maxsize - epsilon, maxsize, maxlength, per_artist,
+            per_album, stratify, Random(seed))
+
+    if curr_size < maxsize - epsilon:
+        print("budget_sample() stopped below the target size", file=stderr)
+
+    return curr_size, curr_length, PathSet(table.paths[i]
+                                           for i in sorted(chosen))
@@ -0,0 +1,156 @@
+"""
+Transcoding stage of coolsync, to fit lossless libraries on small devices.
+
+Rules are given per source extension as SRC:FORMAT[:QUALITY], e.g.
+flac:ogg:5 (Vorbis quality 5), flac:mp3:2 (LAME V2) or wav:opus:128 (kbps).
+Tracks are encoded by ffmpeg, with the tags read by coolsync, and ffmpeg
+writes the destination file itself: it seeks back to complete the headers
+(e.g. the Xing header of mp3, which holds the duration). The output size is
+estimated from the duration and the nominal bitrate of the quality, for the
+space planning.
+"""
+
+from __future__ import print_function
+
+import os
+import errno
+import threading
+import subprocess
+
+try:
+    from shutil import which
+except ImportError:
+    # Python2
+    from distutils.spawn import find_executable as which
+
+
+# format: (extension, ffmpeg arguments, default quality, {quality: kbps})
+FORMATS = {
+    'ogg': ('.ogg', ['-c:a', 'libvorbis', '-q:a', '{q}', '-f', 'ogg'], '5',
+            {'0': 64, '1': 80, '2': 96, '3': 112, '4': 128, '5': 160,
+             '6': 192, '7': 224, '8': 256, '9': 320, '10': 500}),
+    'mp3': ('.mp3', ['-c:a', 'libmp3lame', '-q:a', '{q}', '-f', 'mp3'], '2',
+            {'0': 245, '1': 225, '2': 190, '3': 175, '4': 165, '5': 130,
+             '6': 115, '7': 100, '8': 85, '9': 65}),
+    'opus': ('.opus', ['-c:a', 'libopus', '-b:a', '{q}k', '-f', 'opus'], '128',
+             None),
+}
+
+# coolsync tag keys -> ffmpeg metadata keys (mapped to each container).
+METADATA = {'a': 'artist', 'b': 'album', 'n': 'track', 't': 'title',
+            'y': 'date'}
+
+# Container overhead and tags, per file.
+OVERHEAD = 8 * 1024
+
+
+def parse_rules(specs):
+    """['flac:ogg:5'] -> {'.flac': ('ogg', '5')}"""
+    rules = {}
+    for spec in specs:
+        fields = spec.split(':')
+        if len(fields) not in (2, 3) or fields[1] not in FORMATS:
+            raise ValueError("Invalid transcode rule: %r (SRC:FORMAT[:QUALITY]"
+                             ", formats: %s)" % (spec, ', '.join(sorted(FORMATS))))
+        fmt = fields[1]
+        quality = fields[2] if len(fields) == 3 else FORMATS[fmt][2]
+        if FORMATS[fmt][3] is not None and quality not in FORMATS[fmt][3]:
+            raise ValueError("Invalid %s quality: %r (%s)" % (fmt, quality,
+                             ', '.join(sorted(FORMATS[fmt][3], key=int))))
+        rules['.' + fields[0].lstrip('.').lower()] = (fmt, quality)
+    return rules
+
+
+def output_extension(fmt):
+    return FORMATS[fmt][0]
+
+
+def kbps(fmt, quality):
+    table = FORMATS[fmt][3]
+    return int(quality) if table is None else table[quality]
+
+
+def estimate_size(length, fmt, quality):
+    """Bytes of the encoded output of a track of `length` seconds."""
+    return int((length or 0) * kbps(fmt, quality) * 1000 // 8) + OVERHEAD
+
+
+def metadata(tags):
+    """ffmpeg metadata of the tags of a track ({'a': ..., 'n': ...})."""
+    meta = {}
+    for key, value in tags.items():
+        if key not in METADATA or value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            # m4a track numbers: (number, total)
+            value = '/'.join(str(v) for v in value if v)
+        meta[METADATA[key]] = u'%s' % value
+    return meta
+
+
+def encoder_command(src, dst, fmt, quality, tags, ffmpeg='ffmpeg'):
+    cmd = [ffmpeg, '-nostdin', '-v', 'error', '-i', src,
+           '-map', '0:a:0', '-map_metadata', '-1']
+    for key, value in sorted(metadata(tags).items()):
+        cmd += ['-metadata', u'%s=%s' % (key, value)]
+    # file: so that a colon in the name is not taken for a protocol.
+    return cmd + [arg.format(q=quality) for arg in FORMATS[fmt][1]] + \
+           ['-y', 'file:' + dst]
+
+
+class EncoderError(EnvironmentError):
+    pass
+
+
+def check_encoder(ffmpeg='ffmpeg'):
+    """Path of the encoder. Raise ValueError if it is not installed."""
+    path = which(ffmpeg)
+    if path is None:
+        raise ValueError("Encoder not found: %s" % ffmpeg)
+    return path
+
+
+class Transcoder(object):
+    """Copy function (src, dst) encoding the registered destinations, and
+    copying the other ones with `copy`. At most `jobs` encoders run at the
+    same time."""
+
+    def __init__(self, copy, jobs=None, ffmpeg='ffmpeg'):
+        self.ffmpeg = check_encoder(ffmpeg)
+        self.copy = copy
+        self.jobs = jobs or cpu_count()
+        self.slots = threading.Semaphore(self.jobs)
+        self.encodes = {}
+        if hasattr(copy, 'flush'):
+            self.flush = copy.flush
+
+    def register(self, dst, fmt, quality, tags):
+        self.encodes[dst] = (fmt, quality, tags)
+
+    def __call__(self, src, dst):
+        if dst not in self.encodes:
+            return self.copy(src, dst)
+        fmt, quality, tags = self.encodes[dst]
+        cmd = encoder_command(src, dst, fmt, quality, tags, self.ffmpeg)
+        with self.slots:
+            self.encode(cmd, dst)
+
+    def encode(self, cmd, dst):
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        if proc.returncode:
+            err = err.decode('utf-8', 'replace').strip()
+            # A full device stops the copies to it, like a failed write.
+            code = errno.ENOSPC if os.strerror(errno.ENOSPC) in err else \
+                   errno.EIO
+            raise EncoderError(code, "%s failed (%d): %s" %
+                               (os.path.basename(cmd[0]), proc.returncode,
+                                err), dst)
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
@@ -0,0 +1,152 @@
+"""
+Verification of the copies of coolsync.
+
+The copies are read back from the destination device and hashed, in
+parallel with the sources, in chunks (memory stays flat). Destination files
+are flushed and evicted from the page cache first, so that their bytes are
+read from the device and not from the memory they were copied from.
+
+Source hashes are kept in a persistent cache (like the tags, see
+tagcache.py), and only recomputed when the size, mtime or inode of the
+source changes.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import sqlite3
+
+try:
+    from hashlib import blake2b as new_hash
+except ImportError:
+    # Python2
+    from hashlib import sha1 as new_hash
+
+from tagcache import USER_CACHE_DIR
+
+
+HASH_CACHEFILE = op.join(USER_CACHE_DIR, 'hashes.sqlite')
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS hashes (
+    path   TEXT PRIMARY KEY,
+    size   INTEGER,
+    mtime  REAL,
+    inode  INTEGER,
+    digest TEXT
+)"""
+
+
+class HashCache(object):
+    """Map source paths to the digest of their content."""
+
+    def __init__(self, cachefile=HASH_CACHEFILE):
+        self.cachefile = cachefile
+        cachedir = op.dirname(self.cachefile)
+        if not op.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.db = sqlite3.connect(self.cachefile)
+        self.db.execute(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, st):
+        row = self.db.execute('SELECT size, mtime, inode, digest FROM hashes '
+                              'WHERE path = ?', (op.abspath(path),)).fetchone()
+        if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime, st.st_ino):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[3]
+
+    def put(self, path, digest, st):
+        self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                        (op.abspath(path), st.st_size, st.st_mtime, st.st_ino,
+                         digest))
+
+    def stats(self):
+        return "Hash cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def drop_cache(fd):
+    """Flush the file to the device and evict it from the page cache, so
+    that it is read again from the device."""
+    os.fsync(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def hash_file(path, bufsize=1024**2, uncached=False):
+    h = new_hash()
+    with open(path, 'rb') as F:
+        if uncached:
+            drop_cache(F.fileno())
+        while True:
+            data = F.read(bufsize)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class Verifier(object):
+    """Compare copies to their sources, hashing `jobs` files at a time
+    (hashlib releases the GIL on large buffers)."""
+
+    def __init__(self, cache=None, jobs=4, bufsize=1024**2):
+        self.cache = cache
+        self.jobs = jobs
+        self.bufsize = bufsize
+
+    def __call__(self, pairs):
+        """Verify the (src, dst) copies. Return the list of the failed ones,
+        as (src, dst, reason), including those whose source cannot be
+        read."""
+        from concurrent.futures import ThreadPoolExecutor
+        sources = {}
+        stats = {}
+        unreadable = {}
+        for src, _ in pairs:
+            if src in sources or src in stats or src in unreadable:
+                continue
+            try:
+                stats[src] = os.stat(src)
+            except EnvironmentError as e:
+                unreadable[src] = e.strerror or str(e)
+                continue
+            cached = self.cache.get(src, stats[src]) if self.cache else None
+            if cached is not None:
+                sources[src] = cached
+                del stats[src]
+        failed = []
+        with ThreadPoolExecutor(self.jobs) as executor:
+            hashed = dict((src, executor.submit(hash_file, src, self.bufsize))
+                          for src in stats)
+            copies = [(src, dst, executor.submit(hash_file, dst, self.bufsize,
+                                                 True))
+                      for src, dst in pairs]
+            for src, future in hashed.items():
+                try:
+                    sources[src] = future.result()
+                except EnvironmentError as e:
+                    unreadable[src] = e.strerror or str(e)
+                    continue
+                if self.cache is not None:
+                    self.cache.put(src, sources[src], stats[src])
+            for src, dst, future in copies:
+                if src in unreadable:
+                    failed.append((src, dst, "unreadable source (%s)" %
+                                   unreadable[src]))
+                    continue
+                try:
+                    digest = future.result()
+                except EnvironmentError as e:
+                    failed.append((src, dst, e.strerror or str(e)))
+                    continue
+                if digest != sources[src]:
+                    failed.append((src, dst, "content differs"))
+        return failed